@@ -10,7 +10,7 @@ from engineio import async_threading
 from flask import Flask, request, Response, send_file
 from flask_socketio import SocketIO
 
-from halocoin import tools, engine, custom
+from halocoin import tools, engine, custom, service, verification
 from halocoin.blockchain import BlockchainService
 from halocoin.service import Service
 
@@ -240,22 +240,18 @@ def history():
             encrypted_wallet_content = engine.instance.clientdb.get_wallet(wallet_name)
             wallet = Wallet.from_string(tools.decrypt(password, encrypted_wallet_content))
             address = wallet.address
-    account = engine.instance.statedb.get_account(wallet.address)
+    limit = int(request.values.get('limit', '100'))
+    before = request.values.get('before', None)
+    history, next_cursor = engine.instance.statedb.tx_history(address, limit, before, roles=('send', 'recv'))
     txs = {
         "send": [],
-        "recv": []
+        "recv": [],
+        "next": next_cursor
     }
-    for block_index in reversed(account['tx_blocks']):
-        block = engine.instance.blockchain.get_block(block_index)
-        for tx in block['txs']:
-            if tx['type'] == 'mint':
-                continue
-            tx['block'] = block_index
-            owner = tools.tx_owner_address(tx)
-            if owner == address:
-                txs['send'].append(tx)
-            elif tx['type'] == 'spend' and tx['to'] == address:
-                txs['recv'].append(tx)
+    for block_index, _, role, tx in history:
+        tx = copy.deepcopy(tx)
+        tx['block'] = block_index
+        txs[role].append(tx)
     return generate_json_response(txs)
 
 
@@ -309,8 +305,12 @@ def send():
     if 'pubkeys' not in tx:
         tx['pubkeys'] = [wallet.get_pubkey_str()]  # We use pubkey as string
     if 'signatures' not in tx:
-        tx['signatures'] = [tools.sign(tools.det_hash(tx), wallet.privkey)]
-    engine.instance.blockchain.tx_queue.put(tx)
+        next_length = engine.instance.db.get('length') + 1
+        tx['signatures'] = [tools.sign(tools.det_hash(tx, next_length), wallet.privkey)]
+    submitted = engine.instance.blockchain.submit_tx(tx)
+    if not submitted.getFlag():
+        response['error'] = submitted.getData()
+        return generate_json_response(response)
     response["success"] = True
     response["message"] = "Your transaction is successfully added to the pool"
     response["tx"] = tx
@@ -337,6 +337,16 @@ def mempool():
     return generate_json_response(pool)
 
 
+@app.route('/mempool_stats', methods=['GET', 'POST'])
+def mempool_stats():
+    return generate_json_response(engine.instance.blockchain.tx_pool_stats())
+
+
+@app.route('/snapshots', methods=['GET', 'POST'])
+def snapshots():
+    return generate_json_response(engine.instance.snapshots.available())
+
+
 @app.route('/blocks', methods=['GET', 'POST'])
 def blocks():
     start = int(request.values.get('start', '-1'))
@@ -357,8 +367,9 @@ def blocks():
     }
     for i in range(start, end + 1):
         block = engine.instance.blockchain.get_block(i)
+        # Blocks up to a snapshot that chain was bootstrapped from are not stored
         if block is None:
-            break
+            continue
         mint_tx = list(filter(lambda t: t['type'] == 'mint', block['txs']))[0]
         block['miner'] = tools.tx_owner_address(mint_tx)
         result["blocks"].append(block)
@@ -366,6 +377,30 @@ def blocks():
     return generate_json_response(result)
 
 
+@app.route('/cache_stats', methods=['GET', 'POST'])
+def cache_stats():
+    result = engine.instance.db.cache_stats()
+    result['signatures'] = verification.signature_cache.stats()
+    return generate_json_response(result)
+
+
+@app.route('/lock_profile', methods=['GET', 'POST'])
+def lock_profile():
+    enable = request.values.get('enable', None)
+    disable = request.values.get('disable', None)
+    if enable is not None:
+        service.enable_lock_profiler()
+    elif disable is not None:
+        service.disable_lock_profiler()
+
+    profiler = service.lock_profiler
+    if profiler is None:
+        return generate_json_response({'enabled': False})
+    result = profiler.report()
+    result['enabled'] = True
+    return generate_json_response(result)
+
+
 @app.route('/difficulty', methods=['GET', 'POST'])
 # @blockchain_synced
 def difficulty():
@@ -447,6 +482,7 @@ def status_miner():
     }
     if status['running']:
         status['cpu'] = psutil.cpu_percent()
+        status['hashrate'] = engine.instance.miner.hashrate()
     return generate_json_response(status)
 
 
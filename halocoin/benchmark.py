@@ -0,0 +1,213 @@
+"""
+Micro benchmarks for hot paths of the node.
+Run with: python -m halocoin.benchmark
+"""
+import hashlib
+import os
+import random
+import time
+import types
+
+import yaml
+
+from halocoin import custom, encoding, tools
+
+
+def sample_tx(i=0):
+    return {'type': 'spend',
+            'version': custom.version,
+            'amount': 100 + i,
+            'count': i,
+            'to': '11' + 'a' * 40,
+            'message': '',
+            'pubkeys': [os.urandom(64)],
+            'signatures': [os.urandom(64)]}
+
+
+def sample_block(tx_count=10):
+    return {'version': custom.version,
+            'length': 1000,
+            'time': time.time(),
+            'target': bytearray.fromhex(custom.first_target),
+            'diffLength': '0' * 60 + 'ffff',
+            'prevHash': os.urandom(32),
+            'txs': [sample_tx(i) for i in range(tx_count)]}
+
+
+def hashes_per_second(serializer, obj, duration=1.0):
+    count = 0
+    start = time.time()
+    while time.time() - start < duration:
+        hashlib.sha384(serializer(obj)).digest()
+        count += 1
+    return count / (time.time() - start)
+
+
+def det_hash_encoders(duration=1.0):
+    """
+    Compare hashes/sec of yaml and canonical binary encoders on
+    a block, a single transaction and a nonce/halfHash preimage.
+    :return: {name: (yaml_hps, binary_hps)}
+    """
+    def yaml_serializer(x):
+        return yaml.dump(x).encode()
+
+    samples = {
+        'block': sample_block(),
+        'tx': sample_tx(),
+        'nonce': {'nonce': 2 ** 120, 'halfHash': os.urandom(32)}
+    }
+    results = {}
+    for name, obj in samples.items():
+        results[name] = (hashes_per_second(yaml_serializer, obj, duration),
+                         hashes_per_second(encoding.encode, obj, duration))
+    return results
+
+
+def nonce_search(length, duration=1.0):
+    """
+    Compare nonce tries/sec of building the nonce/halfHash dict on every try
+    with the midstate kernel used by miner workers.
+    :return: (dict_hps, midstate_hps)
+    """
+    half_hash = os.urandom(32)
+
+    count = 0
+    start = time.time()
+    while time.time() - start < duration:
+        tools.det_hash({'nonce': count, 'halfHash': half_hash}, length)
+        count += 1
+    dict_hps = count / (time.time() - start)
+
+    midstate, encode_nonce = tools.pow_midstate(half_hash, length)
+    count = 0
+    start = time.time()
+    while time.time() - start < duration:
+        for nonce in range(count, count + 1000):
+            h = midstate.copy()
+            h.update(encode_nonce(nonce))
+            h.digest()
+        count += 1000
+    return dict_hps, count / (time.time() - start)
+
+
+def tx_throughput(sender_count=10, tx_count=200, duration=1.0):
+    """
+    Compare txs/sec of owner address lookup and signature verification
+    without and with memoized addresses and verifying keys.
+    Txs come from a few senders, like a mempool or a block usually does.
+    :return: (uncached_tps, cached_tps)
+    """
+    from ecdsa import SigningKey, VerifyingKey, SECP256k1
+
+    keys = [SigningKey.generate(curve=SECP256k1) for _ in range(sender_count)]
+    txs = []
+    for i in range(tx_count):
+        key = keys[i % sender_count]
+        tx = sample_tx(i)
+        tx['pubkeys'] = [key.get_verifying_key().to_string()]
+        tx.pop('signatures')
+        msg = tools.det_hash(tx)
+        tx['signatures'] = [key.sign(msg)]
+        txs.append((tx, msg))
+
+    def uncached(tx, msg):
+        tools.make_address.__wrapped__(tx['pubkeys'], len(tx['signatures']))
+        pubkey = VerifyingKey.from_string(tx['pubkeys'][0], curve=SECP256k1)
+        tools.signature_verify(msg, tx['signatures'][0], pubkey)
+
+    def cached(tx, msg):
+        tools.tx_owner_address(tx)
+        tools.signature_verify(msg, tx['signatures'][0], tx['pubkeys'][0])
+
+    results = []
+    for check in (uncached, cached):
+        count = 0
+        start = time.time()
+        while time.time() - start < duration:
+            tx, msg = txs[count % tx_count]
+            check(tx, msg)
+            count += 1
+        results.append(count / (time.time() - start))
+    return tuple(results)
+
+
+def sample_spend_block(tx_count, address_count=1000, fanout=4):
+    """
+    Synthetic block of spends. Addresses only pay others in their own neighborhood of
+    fanout addresses, so block splits into many independent groups.
+    :return: block, initial accounts
+    """
+    from halocoin.state import StateDatabase
+
+    pubkeys = [[os.urandom(64)] for _ in range(address_count)]
+    addresses = [tools.make_address(p, 1) for p in pubkeys]
+    counts = [0] * address_count
+    txs = [{'type': 'mint', 'pubkeys': pubkeys[0], 'signatures': ['first_sig'], 'count': 0}]
+    while len(txs) <= tx_count:
+        sender = random.randrange(address_count)
+        receiver = (sender // fanout) * fanout + random.randrange(fanout)
+        if receiver == sender or receiver >= address_count:
+            continue
+        txs.append({'type': 'spend', 'version': custom.version, 'count': counts[sender],
+                    'pubkeys': pubkeys[sender], 'signatures': [b''], 'amount': 1,
+                    'to': addresses[receiver]})
+        counts[sender] += 1
+    accounts = {}
+    for address in addresses:
+        accounts[address] = StateDatabase.new_account()
+        accounts[address]['amount'] = tx_count
+    return {'length': 1, 'txs': txs}, accounts
+
+
+def block_application(tx_count=5000, duration=2.0):
+    """
+    Compare blocks/sec of applying a synthetic block serially and
+    in parallel by conflict-free groups. Database is not involved.
+    :return: (serial_bps, parallel_bps, group_count)
+    """
+    from halocoin.state import StateDatabase
+
+    block, accounts = sample_spend_block(tx_count)
+    state = StateDatabase(types.SimpleNamespace(db=None, blockchain=None))
+    txs = sorted(enumerate(block['txs']), key=lambda x: x[1]['count'] if 'count' in x[1] else -1)
+    groups = StateDatabase.partition(txs)
+
+    results = []
+    for min_parallel_txs in (tx_count + 1, 0):
+        count = 0
+        start = time.time()
+        while time.time() - start < duration:
+            state.apply_groups(dict(accounts), groups, block['length'], min_parallel_txs)
+            count += 1
+        results.append(count / (time.time() - start))
+    state.close()
+    return results[0], results[1], len(groups)
+
+
+def main():
+    print('det_hash encoders (hashes/sec)')
+    for name, (yaml_hps, binary_hps) in det_hash_encoders().items():
+        print('{:<8} yaml: {:>12.1f} binary: {:>12.1f} speedup: {:.1f}x'
+              .format(name, yaml_hps, binary_hps, binary_hps / yaml_hps))
+
+    print('nonce search (hashes/sec)')
+    for name, length in [('yaml', 0), ('binary', custom.canonical_encoding_height)]:
+        dict_hps, midstate_hps = nonce_search(length)
+        print('{:<8} dict: {:>12.1f} midstate: {:>12.1f} speedup: {:.1f}x'
+              .format(name, dict_hps, midstate_hps, midstate_hps / dict_hps))
+
+    print('tx owner address and signature check (txs/sec)')
+    uncached_tps, cached_tps = tx_throughput()
+    print('uncached: {:>12.1f} cached: {:>12.1f} speedup: {:.1f}x'
+          .format(uncached_tps, cached_tps, cached_tps / uncached_tps))
+
+    print('block application (blocks/sec)')
+    for tx_count in (1000, 5000, 20000):
+        serial_bps, parallel_bps, group_count = block_application(tx_count)
+        print('{:<6} txs in {:<5} groups serial: {:>8.2f} parallel: {:>8.2f} speedup: {:.1f}x'
+              .format(tx_count, group_count, serial_bps, parallel_bps, parallel_bps / serial_bps))
+
+
+if __name__ == '__main__':
+    main()
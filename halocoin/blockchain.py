@@ -1,10 +1,13 @@
 import copy
+import struct
 import threading
 import time
-from cdecimal import Decimal
 
 from halocoin import custom, api
 from halocoin import tools
+from halocoin import verification
+from halocoin.difficulty import RetargetEngine
+from halocoin.mempool import Mempool
 from halocoin.ntwrk import Response
 from halocoin.service import Service, threaded, sync, NoExceptionQueue, lockit
 
@@ -22,26 +25,58 @@ class BlockchainService(Service):
     tx_types = ['spend', 'mint']
     IDLE = 1
     SYNCING = 2
+    # length, time, target, diffLength, prevHash, hash. diffLength is a sum of inverse targets and needs 512 bits.
+    header_format = struct.Struct('>qd32s64s32s32s')
 
     def __init__(self, engine):
         Service.__init__(self, name='blockchain')
         self.engine = engine
         self.blocks_queue = NoExceptionQueue(3)
         self.tx_queue = NoExceptionQueue(100)
-        self.mempool = []
+        mempool_config = self.engine.config.get('mempool', {})
+        self.mempool = Mempool(max_count=mempool_config.get('max_count'),
+                               max_bytes=mempool_config.get('max_bytes'))
+        self.tx_queue_rejected = 0
+        # Blocks connected and disconnected in the ongoing batch. Mempool follows them after commit.
+        self.pool_updates = []
         self.db = None
         self.statedb = None
         self.clientdb = None
         self.__state = BlockchainService.IDLE
         self.addLock = threading.RLock()
+        self.retarget = RetargetEngine(self)
+        self.verifier = verification.SignatureVerifier()
 
     def on_register(self):
         self.db = self.engine.db
         self.statedb = self.engine.statedb
         self.clientdb = self.engine.clientdb
+        self.index_headers()
+        self.statedb.index_transactions()
         print("Started Blockchain")
         return True
 
+    def on_close(self):
+        self.verifier.close()
+        self.statedb.close()
+
+    def index_headers(self):
+        """
+        Chains that were stored before header and hash indexes existed only have full blocks.
+        Build their indexes once.
+        """
+        if self.db.get('block_index_built'):
+            return
+        length = self.db.get('length')
+        if length is not None:
+            for i in range(length + 1):
+                block = self.get_block(i)
+                if block is not None:
+                    header = BlockchainService.make_header(block)
+                    self.db.put('header_' + str(i).zfill(12), BlockchainService.pack_header(header))
+                    self.db.put('height_' + header['hash'].hex(), i)
+        self.db.put('block_index_built', True)
+
     @threaded
     @lockit('write_kvstore')
     def blockchain_process(self):
@@ -68,34 +103,52 @@ class BlockchainService(Service):
                             self.peer_reported_false_blocks(node_id)
                             return
 
+                    # Signatures of the whole batch are checked in parallel before blocks are applied.
+                    signatures_verified = self.verifier.verify_blocks(blocks)
+
+                    self.pool_updates = []
+                    # Snapshots taken in this batch. They are published only if the batch is committed.
+                    snapshots = []
                     self.db.simulate()
                     try:
                         length = self.db.get('length')
+                        newblock_hashes = (tools.det_hash(blocks[0], blocks[0]['length']),
+                                           tools.det_hash(blocks[-1], blocks[-1]['length']))
                         for i in range(20):
-                            block = self.get_block(length)
-                            if self.fork_check(blocks, length, block):
-                                self.delete_block()
+                            header = self.get_header(length)
+                            if self.fork_check(blocks, length, header, newblock_hashes) and self.delete_block():
                                 length -= 1
                             else:
                                 break
 
-                        for block in blocks:
-                            add_block_result = self.add_block(block)
+                        for block, verified in zip(blocks, signatures_verified):
+                            if verified is False:
+                                tools.log('Received block includes a bad signature.')
+                                break
+                            add_block_result = self.add_block(block, signatures_verified=verified is True)
                             if add_block_result == 2:  # A block that is ahead of us could not be added. No need to proceed.
                                 break
                             elif add_block_result == 0:
                                 total_number_of_blocks_added += 1
                                 api.new_block()
+                                if self.engine.snapshots.is_due(block['length']):
+                                    snapshot = self.engine.snapshots.write(block['length'])
+                                    if snapshot is not None:
+                                        snapshots.append(snapshot)
                     except Exception as e:
                         print("halo")
 
                     if total_number_of_blocks_added == 0 or self.db.get('length') != blocks[-1]['length']:
                         # All received blocks failed. Punish the peer by lowering rank.
                         self.db.rollback()
+                        self.engine.snapshots.discard(snapshots)
                         if node_id != 'miner':
                             self.peer_reported_false_blocks(node_id)
                     else:
                         self.db.commit()
+                        self.engine.snapshots.publish(snapshots)
+                        self.tx_pool_update(self.pool_updates)
+                    self.pool_updates = []
             except Exception as e:
                 tools.log(e)
             self.blocks_queue.task_done()
@@ -119,35 +172,123 @@ class BlockchainService(Service):
     def get_chain_state(self):
         return self.__state
 
-    @lockit('kvstore')
+    @lockit('kvstore', shared=True)
     def tx_pool(self):
         """
         Return all the transactions waiting in the pool.
         This method should be used instead of direct access to db
         :return:
         """
-        return self.mempool
+        return self.mempool.txs()
+
+    @lockit('kvstore', shared=True)
+    def tx_pool_by_count(self):
+        """
+        :return: All the transactions in the pool ordered by count
+        """
+        return self.mempool.txs_by_count()
+
+    @lockit('kvstore', shared=True)
+    def tx_pool_contains(self, tx, tx_hash=None):
+        return self.mempool.contains(tx, tx_hash)
+
+    @lockit('kvstore', shared=True)
+    def tx_pool_count(self, address):
+        """
+        :return: Number of transactions from address that are waiting in the pool
+        """
+        return self.mempool.pending_count(address)
+
+    @lockit('kvstore', shared=True)
+    def tx_pool_stats(self):
+        stats = self.mempool.stats()
+        stats['queue_size'] = self.tx_queue.qsize()
+        stats['queue_rejected'] = self.tx_queue_rejected
+        return stats
 
     @lockit('kvstore')
-    def tx_pool_add(self, tx):
+    def tx_pool_add(self, tx, tx_hash=None):
         """
         This is an atomic add operation for txs pool.
+        Transactions with lower priority may be evicted to make room.
         :param tx: Transaction to be added
-        :return: None
+        :param tx_hash: Hash of tx if it is already known
+        :return: Whether tx is in the pool
         """
-        self.mempool.append(tx)
-        api.new_tx_in_pool()
+        if self.mempool.add(tx, tx_hash):
+            api.new_tx_in_pool()
+            return True
+        return False
 
     @lockit('kvstore')
     def tx_pool_pop_all(self):
-        #TODO: empty the pool
         """
         Atomic operation to pop everything
         :return: transactions list
         """
-        mempool = copy.deepcopy(self.mempool)
-        self.mempool = []
-        return mempool
+        return self.mempool.pop_all()
+
+    @lockit('kvstore')
+    def tx_pool_update(self, updates):
+        """
+        Bring mempool up to date with blocks that were connected and disconnected by a committed batch.
+        Included transactions are removed. Transactions of disconnected blocks are admitted back.
+        Their signatures are in signature cache, so integrity check is cheap.
+        Only pending transactions of addresses whose account changed in a way that can
+        invalidate them are checked against the new state again:
+        senders in connected blocks and every address in disconnected blocks.
+        When the next block accepts fewer signature hashing rules than before, every pending
+        signature is checked again, since pending transactions were signed under the old rules.
+        :param updates: List of ('connect' or 'disconnect', block) in the order they happened
+        """
+        length = self.db.get('length')
+        touched = set()
+        previous_length = length - len([u for u in updates if u[0] == 'connect']) + \
+            len([u for u in updates if u[0] == 'disconnect'])
+        if not set(tools.signature_encodings(length + 1)) >= set(tools.signature_encodings(previous_length + 1)):
+            for tx_hash, tx in list(self.mempool.by_hash.items()):
+                if not BlockchainService.tx_signature_check(tx, length + 1):
+                    self.mempool.remove(tx_hash)
+                    # Later transactions of the sender depend on this one
+                    touched.add(tools.tx_owner_address(tx))
+        for action, block in updates:
+            for tx in block['txs']:
+                touched.add(tools.tx_owner_address(tx))
+                if tx['type'] != 'spend':
+                    continue
+                if action == 'connect':
+                    self.mempool.remove(Mempool.tx_hash(tx))
+                else:
+                    touched.add(tx['to'])
+                    if BlockchainService.tx_integrity_check(tx, length + 1).getFlag():
+                        self.mempool.add(tx)
+        for address in touched:
+            self.tx_pool_revalidate(address, length + 1)
+
+    def tx_pool_revalidate(self, address, length):
+        """
+        Apply pending transactions of address to current state in count order.
+        Transactions whose count is already used are removed. After the first one that
+        fails, the rest are removed too since they depend on it.
+        """
+        items = self.mempool.sender_items(address)
+        if len(items) == 0:
+            return
+        self.db.simulate()
+        try:
+            failed = False
+            for tx_hash, tx in items:
+                if not failed:
+                    if tx['count'] < self.statedb.known_tx_count(address, count_pool=False):
+                        # Count is already used by a transaction in chain
+                        self.mempool.remove(tx_hash)
+                        continue
+                    if self.statedb.update_database_with_tx(copy.deepcopy(tx), length):
+                        continue
+                    failed = True
+                self.mempool.remove(tx_hash)
+        finally:
+            self.db.rollback()
 
     def peer_reported_false_blocks(self, node_id):
         peer = self.clientdb.get_peer(node_id)
@@ -156,36 +297,49 @@ class BlockchainService(Service):
             peer['rank'] += 0.2 * 30
             self.clientdb.update_peer(peer)
 
+    def submit_tx(self, tx):
+        """
+        Queue a transaction from outside of blockchain service. Callers are not blocked
+        when queue is full. They are told to try again later.
+        :return: Response
+        """
+        if not self.tx_queue.put(tx, block=False):
+            self.tx_queue_rejected += 1
+            return Response(False, 'Transaction queue is full, try again later')
+        return Response(True, 'Transaction is queued')
+
     def add_tx(self, tx):
         if not isinstance(tx, dict):
             return Response(False, 'Transactions must be dict typed')
 
-        txs_in_pool = self.tx_pool()
-
-        if tx in txs_in_pool:
+        tx_hash = Mempool.tx_hash(tx)
+        if self.tx_pool_contains(tx, tx_hash):
             return Response(False, 'no duplicates')
         if 'type' not in tx or tx['type'] not in BlockchainService.tx_types or tx['type'] == 'mint':
             return Response(False, 'Invalid type')
-        integrity_check = BlockchainService.tx_integrity_check(tx)
+        length = self.db.get('length')
+        integrity_check = BlockchainService.tx_integrity_check(tx, length + 1)
         if not integrity_check.getFlag():
             return Response(False, 'Transaction failed integrity check: ' + integrity_check.getData())
         self.db.simulate()
         _tx = copy.deepcopy(tx)
-        current_state_check = self.statedb.update_database_with_tx(_tx, self.db.get('length')+1, count_pool=True)
+        current_state_check = self.statedb.update_database_with_tx(_tx, length + 1, count_pool=True)
         self.db.rollback()
         if not current_state_check:
             return Response(False, 'Transaction failed current state check')
 
-        self.tx_pool_add(tx)
+        if not self.tx_pool_add(tx, tx_hash):
+            return Response(False, 'Mempool is full')
         return Response(True, 'Added tx into the pool: ' + str(tx))
 
-    def add_block(self, block):
+    def add_block(self, block, signatures_verified=False):
         """Attempts adding a new block to the blockchain.
          Median is good for weeding out liars, so long as the liars don't have 51%
-         hashpower. """
+         hashpower.
+         :param signatures_verified: Signatures of block were already verified by SignatureVerifier """
 
         length = self.db.get('length')
-        block_at_length = self.get_block(length)
+        block_at_length = self.get_header(length)
 
         if int(block['length']) < int(length) + 1:
             return 1
@@ -194,21 +348,23 @@ class BlockchainService(Service):
 
         tools.echo('add block: ' + str(block['length']))
 
-        if (length >= 0 and block['diffLength'] != tools.hex_sum(block_at_length['diffLength'],
-                                                                 tools.hex_invert(block['target']))) \
-                or (length < 0 and block['diffLength'] != tools.hex_invert(block['target'])):
+        expected_work = tools.work(block['target'])
+        if length >= 0:
+            expected_work += block_at_length['diffLength']
+        if block['diffLength'] != tools.work_to_hex(expected_work):
             tools.log(block['diffLength'])
-            tools.log(tools.hex_sum(self.db.get('diffLength'), tools.hex_invert(block['target'])))
+            tools.log(tools.work_to_hex(expected_work))
             tools.log(block['length'])
             tools.log('difflength is wrong')
             return 3
 
-        if length >= 0 and tools.det_hash(block_at_length) != block['prevHash']:
+        if length >= 0 and block_at_length['hash'] != block['prevHash']:
             tools.log('prevhash different')
             return 3
 
         nonce_and_hash = tools.hash_without_nonce(block)
-        if tools.det_hash(nonce_and_hash) > block['target']:
+        pow_hash = tools.det_hash(nonce_and_hash, block['length'])
+        if int.from_bytes(pow_hash, 'big') > tools.target_to_int(block['target']):
             tools.log('hash value does not match the target')
             return 3
 
@@ -238,7 +394,8 @@ class BlockchainService(Service):
             return 3
 
         for tx in block['txs']:
-            if not BlockchainService.tx_integrity_check(tx).getFlag():
+            if not BlockchainService.tx_integrity_check(tx, block['length'],
+                                                        check_signatures=not signatures_verified).getFlag():
                 tools.log('Received block failed special txs check.')
                 return 3
 
@@ -248,11 +405,7 @@ class BlockchainService(Service):
         self.put_block(block['length'], block)
         self.db.put('length', block['length'])
         self.db.put('diffLength', block['diffLength'])
-
-        orphans = self.tx_pool_pop_all()
-
-        for orphan in sorted(orphans, key=lambda x: x['count'] if 'count' in x else -1):
-            self.tx_queue.put(orphan)
+        self.pool_updates.append(('connect', block))
 
         tools.techo('add block: ' + str(block['length']))
         return 0
@@ -261,14 +414,15 @@ class BlockchainService(Service):
         length = self.db.get('length')
         if length < 0:
             return
+        snapshot_length = self.db.get('snapshot_length')
+        if snapshot_length is not None and length <= snapshot_length:
+            # Chain was bootstrapped from a snapshot. Blocks up to it have no transactions to roll back.
+            tools.log('Blocks before the snapshot at {} cannot be deleted'.format(snapshot_length))
+            return
 
         block = self.get_block(length)
         self.statedb.rollback_block(block)
-
-        orphans = self.tx_pool_pop_all()
-
-        for tx in block['txs']:
-            orphans.append(tx)
+        self.pool_updates.append(('disconnect', block))
 
         self.del_block(length)
         length -= 1
@@ -277,28 +431,107 @@ class BlockchainService(Service):
         if length == -1:
             self.db.put('diffLength', '0')
         else:
-            block = self.get_block(length)
-            self.db.put('diffLength', block['diffLength'])
-
-        for orphan in sorted(orphans, key=lambda x: x['count'] if 'count' in x else -1):
-            self.tx_queue.put(orphan)
+            header = self.get_header(length)
+            self.db.put('diffLength', tools.work_to_hex(header['diffLength']))
 
         return True
 
-    @lockit('kvstore')
+    @lockit('kvstore', shared=True)
     def get_block(self, length):
         length = str(length).zfill(12)
         return self.db.get('block_' + length)
 
+    @lockit('kvstore', shared=True)
+    def get_header(self, length):
+        """
+        Header of the block at given length. Headers are fixed size records, so reading them
+        is much cheaper than loading a block with all of its transactions.
+        :return: dict of length, time, target, diffLength, prevHash and hash of the block.
+        target and diffLength are integers.
+        """
+        record = self.db.get('header_' + str(length).zfill(12))
+        if record is None:
+            block = self.get_block(length)
+            if block is None:
+                return None
+            return BlockchainService.make_header(block)
+        return BlockchainService.unpack_header(record)
+
+    @lockit('kvstore', shared=True)
+    def get_block_hash(self, length):
+        header = self.get_header(length)
+        if header is None:
+            return None
+        return header['hash']
+
+    @lockit('kvstore', shared=True)
+    def get_height(self, block_hash):
+        """
+        :param block_hash: Hash of a block
+        :return: Length of the block with given hash in our chain or None
+        """
+        if not isinstance(block_hash, (bytes, bytearray)):
+            return None
+        return self.db.get('height_' + bytes(block_hash).hex())
+
+    @lockit('kvstore', shared=True)
+    def get_block_by_hash(self, block_hash):
+        height = self.get_height(block_hash)
+        if height is None:
+            return None
+        return self.get_block(height)
+
     @lockit('kvstore')
     def put_block(self, length, block):
-        length = str(length).zfill(12)
-        return self.db.put('block_' + length, block)
+        header = BlockchainService.make_header(block)
+        self.db.put('height_' + header['hash'].hex(), length)
+        self.db.put('header_' + str(length).zfill(12), BlockchainService.pack_header(header))
+        result = self.db.put('block_' + str(length).zfill(12), block)
+        self.retarget.block_added(header)
+        return result
 
     @lockit('kvstore')
     def del_block(self, length):
-        length = str(length).zfill(12)
-        return self.db.delete('block_' + length)
+        block_hash = self.get_block_hash(length)
+        if block_hash is not None:
+            self.db.delete('height_' + block_hash.hex())
+        self.retarget.block_removed(length)
+        self.db.delete('header_' + str(length).zfill(12))
+        return self.db.delete('block_' + str(length).zfill(12))
+
+    @staticmethod
+    def make_header(block):
+        return {
+            'length': block['length'],
+            'time': block['time'],
+            'target': tools.target_to_int(block['target']),
+            'diffLength': tools.hex_to_work(block['diffLength']),
+            'prevHash': block.get('prevHash'),
+            'hash': tools.det_hash(block, block['length'])
+        }
+
+    @staticmethod
+    def pack_header(header):
+        prev_hash = header['prevHash'] if header['prevHash'] is not None else b''
+        return BlockchainService.header_format.pack(header['length'],
+                                                    header['time'],
+                                                    header['target'].to_bytes(32, 'big'),
+                                                    header['diffLength'].to_bytes(64, 'big'),
+                                                    bytes(prev_hash).rjust(32, b'\x00'),
+                                                    header['hash'])
+
+    @staticmethod
+    def unpack_header(record):
+        length, block_time, target, diff_length, prev_hash, block_hash = \
+            BlockchainService.header_format.unpack(record)
+        return {
+            'length': length,
+            'time': block_time,
+            'target': int.from_bytes(target, 'big'),
+            'diffLength': int.from_bytes(diff_length, 'big'),
+            'prevHash': prev_hash if length > 0 else None,
+            'hash': block_hash
+        }
 
     @staticmethod
     def block_integrity_check(block):
@@ -328,70 +561,44 @@ class BlockchainService(Service):
 
     @staticmethod
     def sigs_match(_sigs, _pubs, msg):
-        pubs = copy.deepcopy(_pubs)
-        sigs = copy.deepcopy(_sigs)
-
-        def match(sig, pubs, msg):
-            for p in pubs:
-                if tools.signature_verify(msg, sig, p):
-                    return {'bool': True, 'pub': p}
-            return {'bool': False}
-
-        for sig in sigs:
-            a = match(sig, pubs, msg)
-            if not a['bool']:
-                return False
-            sigs.remove(sig)
-            pubs.remove(a['pub'])
-        return True
+        return verification.sigs_match(_sigs, _pubs, msg)
 
     @staticmethod
-    def tx_signature_check(tx):
-        tx_copy = copy.deepcopy(tx)
-        if 'signatures' not in tx or not isinstance(tx['signatures'], (list,)):
-            tools.log('no signatures')
-            return False
-        if 'pubkeys' not in tx or not isinstance(tx['pubkeys'], (list,)):
-            tools.log('no pubkeys')
+    def tx_signature_check(tx, length=None):
+        task = verification.signature_task(tx, length)
+        if task is None:
             return False
-        if len(tx['pubkeys']) == 0:
-            tools.log('pubkey error')
-            return False
-        if len(tx['signatures']) > len(tx['pubkeys']):
-            tools.log('there are more signatures than required')
-            return False
-
-        tx_copy.pop('signatures')
-        msg = tools.det_hash(tx_copy)
-        if not BlockchainService.sigs_match(copy.deepcopy(tx['signatures']),
-                                            copy.deepcopy(tx['pubkeys']), msg):
+        if not verification.verify_cached(task):
             tools.log('sigs do not match')
             return False
         return True
 
-    def fork_check(self, newblocks, length, top_block_on_chain):
+    def fork_check(self, newblocks, length, top_header_on_chain, newblock_hashes):
         """
         Check whether a fork happens while adding these blocks.
         If a fork is detected, return the index of last matched block.
         :param newblocks: Received blocks.
         :param length:
-        :param top_block_on_chain:
+        :param top_header_on_chain: Header of the block at length
+        :param newblock_hashes: Hashes of first and last received blocks
         :return:
         """
-        recent_hash = tools.det_hash(top_block_on_chain)
+        recent_hash = top_header_on_chain['hash'] if top_header_on_chain is not None else None
         their_hashes = list(map(lambda x: x['prevHash'] if x['length'] > 0 else 0, newblocks))
-        their_hashes += [tools.det_hash(newblocks[-1])]
+        their_hashes += [newblock_hashes[1]]
         a = (recent_hash not in their_hashes)
         b = newblocks[0]['length'] - 1 < length < newblocks[-1]['length']
-        c = tools.det_hash(newblocks[0]) == tools.det_hash(self.get_block(newblocks[0]['length']))
+        c = self.get_height(newblock_hashes[0]) == newblocks[0]['length']
         return a and b and c
 
     @staticmethod
-    def tx_integrity_check(tx):
+    def tx_integrity_check(tx, length=None, check_signatures=True):
         """
         This functions test whether a transaction has basic things right.
         Does it have amount, recipient, RIGHT SIGNATURES and correct address types.
         :param tx:
+        :param length: Length of the block that tx is going into. Decides the hashing rule for signatures.
+        :param check_signatures: False when signatures were already verified
         :return:
         """
         if not isinstance(tx, dict):
@@ -403,7 +610,7 @@ class BlockchainService(Service):
         if tx['type'] == 'spend':
             if 'to' not in tx or not isinstance(tx['to'], str):
                 return Response(False, 'Reward or spend transactions must be addressed')
-            if not BlockchainService.tx_signature_check(tx):
+            if check_signatures and not BlockchainService.tx_signature_check(tx, length):
                 return Response(False, 'Transaction is not properly signed')
             if not tools.is_address_valid(tx['to']):
                 return Response(False, 'Address is not valid')
@@ -416,70 +623,15 @@ class BlockchainService(Service):
 
         return Response(True, 'Everything seems fine')
 
-    def recent_block_attributes(self, key, size):
-        length = self.db.get('length')
-        start = max((length - size), 0)
-        result = []
-        for i in range(start, length):
-            result.append(self.get_block(i)[key[:-1]])
-        # start_key = ('block_' + str(start).zfill(12)).encode()
-        # stop_key = ('block_' + str(length).zfill(12)).encode()
-        # blocks = list(self.db.iterator(start=start_key, stop=stop_key, include_stop=False))
-        return result
-
-    @lockit('kvstore')
+    @lockit('kvstore', shared=True)
     def target(self, length):
-        def targetTimesFloat(target, number):
-            a = int(str(target), 16)
-            b = int(a * number)  # this should be rational multiplication followed by integer estimation
-            return tools.buffer_(format(b, 'x'), 64)
-
-        def weights(length):  # uses float
-            # returns from small to big
-            out = custom.memoized_weights[:length]
-            out.reverse()
-            return out
-
-        def estimate_target():
-            """
-            We are actually interested in the average number of hashes required to
-            mine a block. number of hashes required is inversely proportional
-            to target. So we average over inverse-targets, and inverse the final
-            answer. """
-
-            def sumTargets(l):
-                if len(l) < 1:
-                    return 0
-                while len(l) > 1:
-                    l = [tools.hex_sum(l[0], l[1])] + l[2:]
-                return l[0]
-
-            targets = self.recent_block_attributes('targets', custom.history_length)
-            w = weights(len(targets))  # should be rat instead of float
-            tw = sum(w)
-            targets = list(map(tools.hex_invert, targets))
-
-            weighted_targets = [targetTimesFloat(targets[i], w[i] / tw) for i in range(len(targets))]
-            return tools.hex_invert(sumTargets(weighted_targets))
-
-        def estimate_time():
-            times = self.recent_block_attributes('times', custom.history_length)
-            times = list(map(Decimal, times))
-            # How long it took to generate blocks
-            block_times = [times[i] - times[i - 1] for i in range(1, len(times))]
-            w = weights(len(block_times))  # Geometric weighting
-            tw = sum(w)
-            return sum([w[i] * block_times[i] / tw for i in range(len(block_times))])
-
         """ Returns the target difficulty at a particular blocklength. """
         if length < 100:
             return bytearray.fromhex(custom.first_target)  # Use same difficulty for first few blocks.
         if length == 100 or length % custom.recalculate_target_at == 0:
-            retarget = estimate_time() / custom.blocktime
-            result = targetTimesFloat(estimate_target(), retarget)
-            return bytearray.fromhex(result)
+            return self.retarget.retarget(length)
         elif 100 < length < custom.recalculate_target_at:
-            return self.get_block(100)['target']
+            return tools.int_to_target(self.get_header(100)['target'])
         else:
             last_block = length - (length % custom.recalculate_target_at)
-            return self.get_block(last_block)['target']
+            return tools.int_to_target(self.get_header(last_block)['target'])
@@ -0,0 +1,229 @@
+"""
+Checks that consensus critical code agrees with the rules that existing chain was built with.
+Each check compares an optimized path with a plain reference implementation on random input.
+Miner is also checked to keep producing valid nonces across a stop and start.
+Run with: python -m halocoin.consensus_check
+"""
+import os
+import queue
+import random
+import time
+
+from cdecimal import Decimal
+
+from halocoin import custom, encoding, tools
+from halocoin.difficulty import RetargetEngine
+
+
+def reference_target(blocks):
+    """
+    Target of the block after top of chain, the way it was calculated before difficulty math used integers.
+    Hex strings are summed, inverted and scaled by Decimal weights.
+    :param blocks: Chain as list of dicts with time and target, top of chain is the last one
+    """
+    def buffer_(str_to_pad, size):
+        return str_to_pad.rjust(size, '0')
+
+    def hex_sum(a, b):
+        return buffer_(format(int(a, 16) + int(b, 16), 'x'), 64)
+
+    def hex_invert(n):
+        if isinstance(n, bytearray):
+            n = n.hex()
+        return buffer_(format(int('f' * 128, 16) // int(n, 16), 'x'), 64)
+
+    def target_times_float(target, number):
+        return buffer_(format(int(int(str(target), 16) * number), 'x'), 64)
+
+    def weights(size):
+        out = custom.memoized_weights[:size]
+        out.reverse()
+        return out
+
+    def recent(key):
+        top = len(blocks) - 1
+        return [blocks[i][key] for i in range(max(top - custom.history_length, 0), top)]
+
+    def estimate_target():
+        targets = recent('target')
+        w = weights(len(targets))
+        tw = sum(w)
+        targets = list(map(hex_invert, targets))
+        weighted = [target_times_float(targets[i], w[i] / tw) for i in range(len(targets))]
+        while len(weighted) > 1:
+            weighted = [hex_sum(weighted[0], weighted[1])] + weighted[2:]
+        return hex_invert(weighted[0])
+
+    def estimate_time():
+        times = list(map(Decimal, recent('time')))
+        block_times = [times[i] - times[i - 1] for i in range(1, len(times))]
+        w = weights(len(block_times))
+        tw = sum(w)
+        return sum([w[i] * block_times[i] / tw for i in range(len(block_times))])
+
+    retarget = estimate_time() / custom.blocktime
+    return bytearray.fromhex(target_times_float(estimate_target(), retarget))
+
+
+class SyntheticChain:
+    """
+    Just enough of BlockchainService for RetargetEngine: length in db and headers.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.db = self
+
+    def get(self, key):
+        assert key == 'length'
+        return len(self.blocks) - 1
+
+    def get_header(self, length):
+        block = self.blocks[length]
+        return {'length': length, 'time': block['time'], 'target': tools.target_to_int(block['target']),
+                'hash': block['hash']}
+
+    def get_block_hash(self, length):
+        return self.blocks[length]['hash']
+
+
+def synthetic_chain(size):
+    blocks = []
+    block_time = time.time() - size * custom.blocktime
+    for i in range(size):
+        block_time += random.uniform(0.2, 2.5) * custom.blocktime
+        target = random.randrange(2 ** 236, 2 ** 244)
+        blocks.append({'time': block_time, 'target': tools.int_to_target(target), 'hash': os.urandom(32)})
+    return blocks
+
+
+def check_retarget(chains=20):
+    """
+    Targets below custom.exact_retarget_height must be identical to the hex string implementation.
+    """
+    for _ in range(chains):
+        size = random.choice([101, 111, 150, 300])
+        blocks = synthetic_chain(size)
+        engine = RetargetEngine(SyntheticChain(blocks))
+        expected = reference_target(blocks)
+        actual = engine.retarget(size)
+        assert size < custom.exact_retarget_height
+        assert actual == expected, 'Retarget at {} differs: {} != {}'.format(size, actual.hex(), expected.hex())
+
+
+def check_cumulative_work(count=1000):
+    """
+    diffLength of a block must be what hex_sum(previous, hex_invert(target)) gave.
+    """
+    previous_hex = '0'
+    previous = 0
+    for _ in range(count):
+        target = tools.int_to_target(random.randrange(1, 2 ** 256))
+        expected = format(int(previous_hex, 16) + int('f' * 128, 16) // int(target.hex(), 16), 'x').rjust(64, '0')
+        previous += tools.work(target)
+        assert tools.work_to_hex(previous) == expected
+        assert tools.hex_to_work(expected) == previous
+        previous_hex = expected
+
+
+def check_pow_midstate(count=200):
+    """
+    Miner kernel must produce the same hash as det_hash of the nonce and halfHash dict under both rules.
+    """
+    for length in (0, custom.canonical_encoding_height):
+        for _ in range(count):
+            half_hash = os.urandom(32)
+            nonce = random.choice([random.randrange(2 ** 8), random.randrange(2 ** 64), random.randrange(2 ** 140)])
+            midstate, encode_nonce = tools.pow_midstate(half_hash, length)
+            h = midstate.copy()
+            h.update(encode_nonce(nonce))
+            assert h.digest()[0:32] == tools.det_hash({'nonce': nonce, 'halfHash': half_hash}, length)
+
+
+def check_canonical_encoding(count=200):
+    """
+    Canonical encoding must not depend on dict insertion order.
+    """
+    for _ in range(count):
+        tx = {'type': 'spend', 'version': custom.version, 'amount': random.randrange(10 ** 6),
+              'count': random.randrange(100), 'to': '11' + 'a' * 40, 'message': '',
+              'pubkeys': [os.urandom(64)], 'signatures': [os.urandom(64)]}
+        items = list(tx.items())
+        random.shuffle(items)
+        assert encoding.encode(tx) == encoding.encode(dict(items))
+
+
+def check_signature_transition():
+    """
+    A tx signed for the block before canonical_encoding_height must stay valid within the transition
+    window and be rejected after it. Same for a tx signed under the new rule that ends up before the switch.
+    """
+    from ecdsa import SigningKey, SECP256k1
+    from halocoin import verification
+
+    height = custom.canonical_encoding_height
+    window = custom.signature_transition_blocks
+    key = SigningKey.generate(curve=SECP256k1)
+    for signed_for, valid, invalid in [(height - 1, [height - 1, height, height + window - 1], [height + window]),
+                                       (height, [height - window + 1, height - 1, height], [height - window])]:
+        tx = {'type': 'spend', 'version': custom.version, 'amount': 1, 'count': 0, 'to': '11' + 'a' * 40,
+              'message': '', 'pubkeys': [key.get_verifying_key().to_string()]}
+        tx['signatures'] = [tools.sign(tools.det_hash(tx, signed_for), key)]
+        for length in valid:
+            assert verification.verify_task(verification.signature_task(tx, length)), \
+                'Signed for {}, rejected at {}'.format(signed_for, length)
+        for length in invalid:
+            assert not verification.verify_task(verification.signature_task(tx, length)), \
+                'Signed for {}, accepted at {}'.format(signed_for, length)
+
+
+def check_miner_restart(cores=2, timeout=10):
+    """
+    Workers started after a stop must mine the next job, not exit on the STOP job left by the previous ones.
+    """
+    import types
+    from halocoin.miner import MinerService
+
+    miner = MinerService(types.SimpleNamespace(config={'miner': {'cores': cores}}))
+    block = {'version': custom.version, 'length': 1, 'time': time.time(), 'txs': [],
+             'target': bytearray.fromhex('7' + 'f' * 63)}
+    try:
+        for _ in range(2):
+            generation = miner.start_workers(block)
+            deadline = time.time() + timeout
+            found = None
+            while found is None and time.time() < deadline:
+                try:
+                    job_generation, nonce = miner.queue.get(timeout=max(deadline - time.time(), 0.01))
+                except queue.Empty:
+                    break
+                if job_generation == generation:
+                    found = nonce
+            assert found is not None, 'Miner did not find a nonce'
+            assert all(p.is_alive() for p in miner.pool), 'Miner workers exited'
+            pow_hash = tools.det_hash(tools.hash_without_nonce(dict(block, nonce=found)), block['length'])
+            assert pow_hash <= bytes(block['target'])
+            miner.close_workers()
+    finally:
+        miner.close_workers()
+
+
+checks = [check_retarget, check_cumulative_work, check_pow_midstate, check_canonical_encoding,
+          check_signature_transition, check_miner_restart]
+
+
+def main():
+    failed = 0
+    for check in checks:
+        try:
+            check()
+            print('{:<28} ok'.format(check.__name__))
+        except AssertionError as e:
+            failed += 1
+            print('{:<28} FAILED {}'.format(check.__name__, e))
+    if failed > 0:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import os
 from cdecimal import Decimal
+from fractions import Fraction
 
 version = "0.0013"
 block_reward = 500  # Initial block reward
@@ -19,9 +20,37 @@ inflection = Decimal('0.98')
 blocktime = 60
 halve_at = (365 * 24 * 60 * 60 / blocktime)  # Approximately one year
 recalculate_target_at = (4*60*60 // blocktime)  # It's every half day
+# Blocks at or after this length are hashed with canonical binary encoding instead of yaml.
+canonical_encoding_height = 50000
+# Txs are signed before it is known which block they go into. Within this many blocks on either side
+# of canonical_encoding_height, signatures made under either hashing rule are accepted.
+signature_transition_blocks = 1000
+
+# Retarget at or after this length uses exact rational weights instead of Decimal ones.
+exact_retarget_height = 50000
+
+# Number of most recent blocks that keep an undo record of the accounts they changed
+undo_depth = 100
+
+# Blocks with at least this many transactions apply independent groups of them in a process pool.
+# Applying a transaction is cheap compared to sending it to another process, so it is off by default.
+# python -m halocoin.benchmark shows whether it pays off on a machine.
+parallel_apply_min_txs = None
+
+# Account state is written to a snapshot file at every multiple of this length. None turns snapshots off.
+snapshot_interval = 10000
+# Number of most recent snapshot files that are kept
+snapshots_kept = 2
+# Snapshots that an empty node may bootstrap from. length -> sha256 of the snapshot file in hex.
+# More can be trusted through the snapshot section of config.
+state_checkpoints = {}
+# Snapshots larger than this many bytes are not downloaded from peers.
+# Can be changed through max_size in snapshot section of config.
+snapshot_max_size = 2 * 1024 ** 3
 
 # Precalculate
 memoized_weights = [inflection ** i for i in range(history_length)]
+exact_weights = [Fraction(49, 50) ** i for i in range(history_length)]
 
 
 first_target = '0' * 4 + 'f' * 60
@@ -30,6 +59,7 @@ first_target = '0' * 4 + 'f' * 60
 def generate_default_config():
     config = dict()
     config['DEBUG'] = False
+    config['profile_locks'] = False
     config['database'] = {
         "type": "sql",
         "location": "halocoin.db"
@@ -61,6 +91,18 @@ def generate_default_config():
     config["miner"] = {
         "cores": -1
     }
+
+    config["mempool"] = {
+        "max_count": 20000,
+        "max_bytes": 16 * 1024 * 1024
+    }
+
+    config["snapshot"] = {
+        "directory": "snapshots",
+        "file": "",
+        "checkpoints": {},
+        "max_size": snapshot_max_size
+    }
     return config
 
 
@@ -2,24 +2,42 @@ import os
 import pickle
 import sys
 import threading
+from collections import OrderedDict
 
 import plyvel
 
 from halocoin import tools, custom
-from halocoin.service import lockit
 
 
 class KeyValueStore:
+    """
+    Pickle based key value store on top of LevelDB.
+    Committed values are kept in a bounded LRU cache of their pickled bytes.
+    Values of immutable types are also kept decoded and returned as they are.
+    Mutable values are unpickled from the cached bytes, so callers can modify
+    what they get without touching the cache.
+    Reads do not take any service lock. Simulating threads read from their own
+    snapshot and every write goes through a single committer lock.
+    """
+    # Upper limit for total size of cached pickles in bytes
+    cache_limit = 32 * 1024 * 1024
+    immutable_types = (int, float, str, bytes, bool, type(None))
+
     def __init__(self, engine, dbname):
         self.engine = engine
         self.dbname = dbname
         self.DB = None
         self.iterator = None
-        self.simulating = False
-        self.simulation_owner = ''
+        self.local = threading.local()
+        self.commit_lock = threading.Lock()
         self.salt = None
         self.req_count = 0
-        self.log = dict()
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_bytes = 0
+        self.cache_epoch = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
         try:
             db_location = os.path.join(self.engine.working_dir, self.dbname)
             DB = plyvel.DB(db_location, create_if_missing=True)
@@ -29,36 +47,160 @@ class KeyValueStore:
             tools.log(e)
             sys.stderr.write('Database connection cannot be established!\n')
 
-    @lockit('kvstore')
+    def from_database(self, key, snapshot=None, snapshot_epoch=None):
+        """
+        Read a committed value. Cache is used as long as nothing was written
+        after the given snapshot was taken. Otherwise value is read from the snapshot.
+        """
+        key = str(key)
+        with self.cache_lock:
+            epoch = self.cache_epoch
+            if snapshot is not None and snapshot_epoch != epoch:
+                entry = None
+                use_cache = False
+            else:
+                entry = self.cache.get(key)
+                use_cache = True
+            if entry is not None:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+        if entry is not None:
+            raw, value, immutable = entry
+            if immutable:
+                return value
+            return pickle.loads(raw)
+
+        try:
+            raw = (self.DB if snapshot is None else snapshot).get(key.encode())
+            value = None if raw is None else pickle.loads(raw)
+        except Exception as e:
+            return None
+        if use_cache:
+            immutable = isinstance(value, KeyValueStore.immutable_types)
+            self.cache_insert(key, raw, value if immutable else None, immutable, epoch)
+        return value
+
+    def cache_insert(self, key, raw, value, immutable, epoch):
+        size = len(key) + (0 if raw is None else len(raw))
+        if size > KeyValueStore.cache_limit:
+            return
+        with self.cache_lock:
+            # A write happened after we read from database. What we read may be stale.
+            if epoch != self.cache_epoch:
+                return
+            if key in self.cache:
+                old_raw = self.cache.pop(key)[0]
+                self.cache_bytes -= len(key) + (0 if old_raw is None else len(old_raw))
+            self.cache[key] = (raw, value, immutable)
+            self.cache_bytes += size
+            while self.cache_bytes > KeyValueStore.cache_limit:
+                old_key, (old_raw, _, _) = self.cache.popitem(last=False)
+                self.cache_bytes -= len(old_key) + (0 if old_raw is None else len(old_raw))
+
+    def cache_invalidate(self, keys):
+        with self.cache_lock:
+            self.cache_epoch += 1
+            for key in keys:
+                entry = self.cache.pop(str(key), None)
+                if entry is not None:
+                    self.cache_bytes -= len(str(key)) + (0 if entry[0] is None else len(entry[0]))
+
+    def cache_stats(self):
+        with self.cache_lock:
+            return {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'entries': len(self.cache),
+                'bytes': self.cache_bytes
+            }
+
+    def thread_state(self):
+        """
+        Simulation state of the current thread.
+        log is the stack of savepoints, snapshot is the LevelDB snapshot that
+        the simulation reads from and epoch is the cache epoch at the time snapshot was taken.
+        """
+        if not hasattr(self.local, 'log'):
+            self.local.log = []
+            self.local.snapshot = None
+            self.local.epoch = None
+        return self.local
+
+    @property
+    def simulating(self):
+        return len(self.thread_state().log) > 0
+
     def get(self, key):
-        def from_database(key):
-            try:
-                return pickle.loads(self.DB.get(str(key).encode()))
-            except Exception as e:
-                return None
-
-        tname = threading.current_thread().getName()
-        if (not self.simulating) or (tname != self.simulation_owner and self.simulating) or \
-                (tname == self.simulation_owner and self.simulating and str(key) not in self.log):
-            return from_database(key)
-        else:
-            return self.log[str(key)]
+        state = self.thread_state()
+        if len(state.log) > 0:
+            for savepoint in reversed(state.log):
+                if str(key) in savepoint:
+                    return savepoint[str(key)]
+            return self.from_database(key, state.snapshot, state.epoch)
+        return self.from_database(key)
 
     def put(self, key, value):
         try:
-            tname = threading.current_thread().getName()
-            if tname != self.simulation_owner and self.simulating:
-                raise EnvironmentError('There is a simulation going on! You cannot write to database from {}'
-                                       .format(tname))
-            elif tname == self.simulation_owner and self.simulating:
-                self.log[str(key)] = value
-            elif not self.simulating:
-                self.DB.put(str(key).encode(), pickle.dumps(value))
+            state = self.thread_state()
+            if len(state.log) > 0:
+                state.log[-1][str(key)] = value
+            else:
+                with self.commit_lock:
+                    if value is None:
+                        self.DB.delete(str(key).encode())
+                    else:
+                        self.DB.put(str(key).encode(), pickle.dumps(value))
+                    self.cache_invalidate([key])
             return True
         except Exception as e:
             return False
 
-    @lockit('kvstore')
+    def iterate(self, start, stop, reverse=False, pending=False):
+        """
+        Committed (key, value) pairs with start <= key < stop in key order.
+        Changes of an ongoing simulation are not visible unless pending is True.
+        :param pending: Merge in changes of the ongoing simulation of this thread. Committed pairs
+        are then read from the snapshot that simulation started with.
+        """
+        start = str(start)
+        stop = str(stop)
+        state = self.thread_state()
+        if not pending or len(state.log) == 0:
+            for key, raw in self.DB.iterator(start=start.encode(), stop=stop.encode(), reverse=reverse):
+                value = pickle.loads(raw)
+                # Deletes outside of simulations used to store a pickled None
+                if value is not None:
+                    yield key.decode(), value
+            return
+
+        changes = dict()
+        for savepoint in state.log:
+            for key, value in savepoint.items():
+                if start <= key < stop:
+                    changes[key] = value
+        changed_keys = sorted(changes.keys(), reverse=reverse)
+        j = 0
+        for raw_key, raw in state.snapshot.iterator(start=start.encode(), stop=stop.encode(), reverse=reverse):
+            key = raw_key.decode()
+            while j < len(changed_keys) and (changed_keys[j] > key if reverse else changed_keys[j] < key):
+                if changes[changed_keys[j]] is not None:
+                    yield changed_keys[j], changes[changed_keys[j]]
+                j += 1
+            if j < len(changed_keys) and changed_keys[j] == key:
+                if changes[key] is not None:
+                    yield key, changes[key]
+                j += 1
+            else:
+                value = pickle.loads(raw)
+                if value is not None:
+                    yield key, value
+        for key in changed_keys[j:]:
+            if changes[key] is not None:
+                yield key, changes[key]
+
     def exists(self, key):
         result = self.get(key)
         return result is not None
@@ -66,46 +208,77 @@ class KeyValueStore:
     def delete(self, key):
         return self.put(key, None)
 
-    @lockit('kvstore')
     def simulate(self):
         """
         Database simulations are thread based batch transactions.
         When a simulation is started by a thread, any get or put operation
-        is executed on the simulated database.
+        from that thread is executed on the simulated database.
+
+        Every thread can run its own simulation. It reads from a LevelDB snapshot
+        taken when the simulation started, so simulations never see each other and
+        never block readers. Threads that are not simulating read the last committed state.
 
-        Other threads
+        Simulations can be nested. Each nested simulate call opens a savepoint that
+        can be committed into its parent or rolled back without affecting it.
         :return:
         """
-        if self.simulating:
-            tools.log('There is already an ongoing simulation! {}'.format(threading.current_thread().getName()))
-            return False
+        state = self.thread_state()
         try:
-            self.simulating = True
-            self.simulation_owner = threading.current_thread().getName()
+            if len(state.log) == 0:
+                with self.cache_lock:
+                    state.epoch = self.cache_epoch
+                state.snapshot = self.DB.snapshot()
+            state.log.append(dict())
             return True
-        except:
+        except Exception as e:
+            tools.log(e)
             return False
 
-    @lockit('kvstore')
     def commit(self):
         """
-        Commit simply erases the earlier snapshot.
+        Commit the innermost savepoint. If it is nested, changes are merged into its parent.
+        Otherwise every change is written to database in one atomic write batch.
+        All writes to database pass through commit_lock, there is a single committer at a time.
         :return:
         """
-        if not self.simulating:
+        state = self.thread_state()
+        if len(state.log) == 0:
             tools.log('There isn\'t any ongoing simulation')
             return False
-        for key, value in self.log.items():
-            self.DB.put(str(key).encode(), pickle.dumps(value))
-        self.log = dict()
-        self.simulating = False
+        savepoint = state.log.pop()
+        if len(state.log) > 0:
+            state.log[-1].update(savepoint)
+            return True
+        with self.commit_lock:
+            with self.DB.write_batch(transaction=True) as wb:
+                for key, value in savepoint.items():
+                    if value is None:
+                        wb.delete(str(key).encode())
+                    else:
+                        wb.put(str(key).encode(), pickle.dumps(value))
+            self.cache_invalidate(savepoint.keys())
+        self.release_snapshot(state)
         return True
 
-    @lockit('kvstore')
     def rollback(self):
-        if not self.simulating:
+        """
+        Discard the innermost savepoint.
+        :return:
+        """
+        state = self.thread_state()
+        if len(state.log) == 0:
             tools.log('There isn\'t any ongoing simulation')
             return False
-        self.log = dict()
-        self.simulating = False
-        return True
\ No newline at end of file
+        state.log.pop()
+        if len(state.log) == 0:
+            self.release_snapshot(state)
+        return True
+
+    @staticmethod
+    def release_snapshot(state):
+        try:
+            state.snapshot.close()
+        except Exception as e:
+            pass
+        state.snapshot = None
+        state.epoch = None
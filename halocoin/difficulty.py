@@ -0,0 +1,147 @@
+import threading
+from collections import deque, OrderedDict, namedtuple
+from cdecimal import Decimal
+from fractions import Fraction
+
+from halocoin import custom
+from halocoin import tools
+
+WindowEntry = namedtuple('WindowEntry', ['length', 'hash', 'time', 'inverse_target'])
+
+
+class RetargetEngine:
+    """
+    Difficulty retarget needs time and target of the last history_length blocks.
+    Instead of reading them from database on every call, they are kept in a ring buffer
+    that is updated when blocks are added or deleted.
+
+    Ring buffer is only a cache. Blocks may be added inside a simulation that is
+    rolled back, or by another thread that sees a different chain. Before every use,
+    the entry at the top of the chain is compared by hash with the buffer and
+    buffer is rebuilt from block headers when they do not match.
+    Since blocks are hash linked, a matching top means the whole window matches.
+
+    Computed targets are memoized by (length, top length, top hash) which stays
+    correct across reorgs.
+
+    Starting from custom.exact_retarget_height, weights and averages are exact
+    rationals. Earlier heights keep the Decimal based calculation they were mined with.
+    """
+    memo_size = 64
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.window = deque(maxlen=custom.history_length + 1)
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_from_header(header):
+        return WindowEntry(header['length'], header['hash'], header['time'], tools.work(header['target']))
+
+    def block_added(self, header):
+        with self.lock:
+            if len(self.window) > 0 and self.window[-1].length + 1 == header['length']:
+                self.window.append(RetargetEngine.entry_from_header(header))
+
+    def block_removed(self, length):
+        with self.lock:
+            while len(self.window) > 0 and self.window[-1].length >= length:
+                self.window.pop()
+
+    def sync(self, top_length, top_hash):
+        """
+        Make sure window holds blocks max(top_length - history_length, 0)...top_length of current chain.
+        Must be called with self.lock held.
+        """
+        while len(self.window) > 0 and self.window[-1].length > top_length:
+            self.window.pop()
+        expected_size = min(top_length + 1, self.window.maxlen)
+        if len(self.window) == expected_size and len(self.window) > 0 and \
+                self.window[-1].length == top_length and self.window[-1].hash == top_hash:
+            return
+        self.window.clear()
+        for i in range(max(top_length - custom.history_length, 0), top_length + 1):
+            self.window.append(RetargetEngine.entry_from_header(self.blockchain.get_header(i)))
+
+    def retarget(self, length):
+        """
+        Target of a block at a retarget height.
+        Window consists of blocks max(top - history_length, 0) ... top - 1, where top is the length of the chain.
+        :param length: Length of the block that target is calculated for
+        :return: target as bytearray
+        """
+        top_length = self.blockchain.db.get('length')
+        top_hash = self.blockchain.get_block_hash(top_length)
+        key = (length, top_length, top_hash)
+        with self.lock:
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                return bytearray(self.memo[key])
+
+            self.sync(top_length, top_hash)
+            entries = [entry for entry in self.window if entry.length < top_length]
+            if length >= custom.exact_retarget_height:
+                result = RetargetEngine.calculate_exact(entries)
+            else:
+                result = RetargetEngine.calculate(entries)
+
+            self.memo[key] = bytes(result)
+            while len(self.memo) > RetargetEngine.memo_size:
+                self.memo.popitem(last=False)
+        return result
+
+    @staticmethod
+    def weights(length):  # uses float
+        # returns from small to big
+        out = custom.memoized_weights[:length]
+        out.reverse()
+        return out
+
+    @staticmethod
+    def calculate(entries):
+        def estimate_target():
+            """
+            We are actually interested in the average number of hashes required to
+            mine a block. number of hashes required is inversely proportional
+            to target. So we average over inverse-targets, and inverse the final
+            answer. """
+            w = RetargetEngine.weights(len(entries))  # should be rat instead of float
+            tw = sum(w)
+            weighted_sum = 0
+            for i, entry in enumerate(entries):
+                # this should be rational multiplication followed by integer estimation
+                weighted_sum += int(entry.inverse_target * (w[i] / tw))
+            return tools.max_work_numerator // weighted_sum
+
+        def estimate_time():
+            times = [Decimal(entry.time) for entry in entries]
+            # How long it took to generate blocks
+            block_times = [times[i] - times[i - 1] for i in range(1, len(times))]
+            w = RetargetEngine.weights(len(block_times))  # Geometric weighting
+            tw = sum(w)
+            return sum([w[i] * block_times[i] / tw for i in range(len(block_times))])
+
+        retarget = estimate_time() / custom.blocktime
+        result = int(estimate_target() * retarget)
+        return tools.int_to_target(result)
+
+    @staticmethod
+    def calculate_exact(entries):
+        """
+        Same estimation as calculate, with rational weights and block times.
+        Only the final target is rounded down to an integer.
+        """
+        w = custom.exact_weights[:len(entries)]
+        w.reverse()
+        weighted_work = sum(entry.inverse_target * w[i] for i, entry in enumerate(entries)) / sum(w)
+        estimated_target = Fraction(tools.max_work_numerator) / weighted_work
+
+        times = [Fraction(entry.time) for entry in entries]
+        block_times = [times[i] - times[i - 1] for i in range(1, len(times))]
+        w = custom.exact_weights[:len(block_times)]
+        w.reverse()
+        estimated_time = sum(w[i] * block_times[i] for i in range(len(block_times))) / sum(w)
+
+        retarget = estimated_time / custom.blocktime
+        return tools.int_to_target(int(estimated_target * retarget))
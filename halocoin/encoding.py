@@ -0,0 +1,117 @@
+"""
+Canonical binary encoding of blocks, transactions and proof of work preimages.
+
+YAML dumps were used to get a deterministic representation of python objects
+before hashing. That is slow and depends on the yaml library version. This module
+produces a versioned, deterministic byte string for the subset of python types
+that appear in blockchain objects.
+
+Every top-level encoding starts with a version byte. Each value is prefixed by
+a one byte type tag. Lengths are unsigned LEB128 varints. Dictionary keys must be
+strings and entries are sorted by their utf-8 bytes, so insertion order does not
+change the result.
+"""
+import struct
+
+VERSION = 1
+
+TAG_NONE = b'N'
+TAG_FALSE = b'F'
+TAG_TRUE = b'T'
+TAG_INT = b'I'
+TAG_NEG_INT = b'J'
+TAG_FLOAT = b'R'
+TAG_BYTES = b'B'
+TAG_STR = b'S'
+TAG_LIST = b'L'
+TAG_DICT = b'D'
+
+
+class EncodingError(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+def encode_varint(n):
+    if n < 0:
+        raise EncodingError('Varints cannot be negative')
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def encode_int(n):
+    tag = TAG_INT
+    if n < 0:
+        tag = TAG_NEG_INT
+        n = -n
+    size = (n.bit_length() + 7) // 8
+    return tag + encode_varint(size) + n.to_bytes(size, 'big')
+
+
+def _encode(x, out):
+    if x is None:
+        out += TAG_NONE
+    elif x is True:
+        out += TAG_TRUE
+    elif x is False:
+        out += TAG_FALSE
+    elif isinstance(x, int):
+        out += encode_int(x)
+    elif isinstance(x, float):
+        out += TAG_FLOAT + struct.pack('>d', x)
+    elif isinstance(x, (bytes, bytearray)):
+        out += TAG_BYTES + encode_varint(len(x)) + x
+    elif isinstance(x, str):
+        raw = x.encode('utf-8')
+        out += TAG_STR + encode_varint(len(raw)) + raw
+    elif isinstance(x, (list, tuple)):
+        out += TAG_LIST + encode_varint(len(x))
+        for item in x:
+            _encode(item, out)
+    elif isinstance(x, dict):
+        items = []
+        for key, value in x.items():
+            if not isinstance(key, str):
+                raise EncodingError('Dictionary keys must be strings')
+            items.append((key.encode('utf-8'), value))
+        items.sort(key=lambda item: item[0])
+        out += TAG_DICT + encode_varint(len(items))
+        for raw_key, value in items:
+            out += TAG_STR + encode_varint(len(raw_key)) + raw_key
+            _encode(value, out)
+    else:
+        raise EncodingError('Type {} cannot be canonically encoded'.format(type(x).__name__))
+
+
+def encode(x):
+    """
+    Canonical byte representation of dict, list, int, float, bytes or string.
+    :param x: Object to be encoded
+    :return: bytes
+    """
+    out = bytearray([VERSION])
+    _encode(x, out)
+    return bytes(out)
+
+
+def pow_prefix(half_hash):
+    """
+    Encoding of {'halfHash': half_hash, 'nonce': nonce} up to the nonce value.
+    Since 'halfHash' sorts before 'nonce', only the trailing bytes depend on the nonce.
+    Miners can hash this prefix once and append encode_int(nonce) for each try.
+    :param half_hash: Hash of the block without nonce
+    :return: bytes
+    """
+    out = bytearray([VERSION])
+    out += TAG_DICT + encode_varint(2)
+    _encode('halfHash', out)
+    _encode(half_hash, out)
+    _encode('nonce', out)
+    return bytes(out)
@@ -1,3 +1,4 @@
+import json
 import signal
 import sys
 import time
@@ -5,6 +6,7 @@ import time
 import psutil
 
 from halocoin import api
+from halocoin import service
 from halocoin import tools
 from halocoin.blockchain import BlockchainService
 from halocoin.client_db import ClientDB
@@ -13,6 +15,7 @@ from halocoin.miner import MinerService
 from halocoin.peer_check import PeerCheckService
 from halocoin.peer_listen import PeerListenService
 from halocoin.service import Service, async, threaded
+from halocoin.snapshot import SnapshotStore
 from halocoin.state import StateDatabase
 
 
@@ -51,11 +54,15 @@ class Engine(Service):
         self.peer_receive = PeerListenService(self)
         self.clientdb = ClientDB(self)
         self.statedb = StateDatabase(self)
+        self.snapshots = SnapshotStore(self)
         self.miner = MinerService(self)
 
     def on_register(self):
         print('Starting halocoin')
 
+        if self.config.get('profile_locks', False):
+            service.enable_lock_profiler()
+
         if not test_database(self.db):
             tools.log("Database service is not working.")
             return False
@@ -78,6 +85,11 @@ class Engine(Service):
             self.unregister_sub_services()
             return False
 
+        snapshot_file = self.config.get('snapshot', {}).get('file')
+        if snapshot_file and self.db.get('length') == -1:
+            result = self.snapshots.load(snapshot_file)
+            print(result.getData())
+
         if not self.peer_receive.register():
             sys.stderr.write("Peer Receive service has failed. Exiting!\n")
             self.unregister_sub_services()
@@ -107,9 +119,9 @@ class Engine(Service):
             self.blockchain.unregister()
             running_services.add(self.blockchain)
 
-        for service in running_services:
-            service.join()
-            print('Closed {}'.format(service.name))
+        for s in running_services:
+            s.join()
+            print('Closed {}'.format(s.name))
 
     @threaded
     def stats(self):
@@ -130,12 +142,24 @@ def signal_handler(signal, frame):
         instance.stop()
 
 
+def lock_profile_handler(signal, frame):
+    profiler = service.lock_profiler
+    if profiler is None:
+        sys.stderr.write('Lock profiler is not enabled\n')
+        return
+    report = json.dumps(profiler.report(), indent=2)
+    tools.log(report)
+    sys.stderr.write(report + '\n')
+
+
 def main(config, working_dir):
     global instance
     instance = Engine(config, working_dir)
     if instance.register():
         print("Halocoin is fully running...")
         signal.signal(signal.SIGINT, signal_handler)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lock_profile_handler)
         instance.join()
         print("Shutting down gracefully")
     else:
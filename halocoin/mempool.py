@@ -0,0 +1,215 @@
+import bisect
+import hashlib
+import heapq
+from collections import OrderedDict
+
+import yaml
+
+from halocoin import encoding, tools
+
+
+class Mempool:
+    """
+    Pending transactions indexed by hash and by sender.
+    Each sender has a queue of its transactions ordered by count, so duplicate
+    checks and pending count of an address do not scan the whole pool.
+
+    Pool is limited by number of transactions and by their total encoded size.
+    When a limit is exceeded, transactions are evicted by priority:
+    - Sender with the most pending transactions loses first, so a single sender cannot fill the pool.
+    - The last transaction of that sender goes, since transactions with higher count depend on lower ones.
+    - Between senders with equally long queues, the one whose last transaction is newest loses.
+    A new transaction that would be evicted first is not admitted at all.
+    Senders are kept in a heap by that priority, so finding the victim does not scan the pool.
+    Heap entries are not removed when a queue changes. A new entry is pushed instead and
+    entries that no longer match their queue are skipped when they reach the top.
+
+    Mempool is not thread safe. BlockchainService guards it with kvstore lock.
+    """
+
+    def __init__(self, max_count=None, max_bytes=None):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        # tx hash -> tx, in arrival order
+        self.by_hash = OrderedDict()
+        # sender address -> sorted list of (count, tx hash)
+        self.by_sender = dict()
+        # tx hash -> (arrival sequence, encoded size)
+        self.meta = dict()
+        # (-queue length, -arrival sequence of queue tail, sender). Lowest one is evicted first.
+        self.eviction_heap = []
+        self.sequence = 0
+        self.total_bytes = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self.rejected = 0
+
+    @staticmethod
+    def encode_tx(tx):
+        """
+        Pool identity and size of a tx. It is never sent to peers, so the faster
+        canonical encoding is used regardless of chain height.
+        """
+        try:
+            return encoding.encode(tx)
+        except encoding.EncodingError:
+            return yaml.dump(tx).encode()
+
+    @staticmethod
+    def tx_hash(tx):
+        return hashlib.sha256(Mempool.encode_tx(tx)).digest()
+
+    @staticmethod
+    def tx_count(tx):
+        return tx['count'] if 'count' in tx else -1
+
+    def __len__(self):
+        return len(self.by_hash)
+
+    def __iter__(self):
+        return iter(list(self.by_hash.values()))
+
+    def contains(self, tx, tx_hash=None):
+        if tx_hash is None:
+            tx_hash = Mempool.tx_hash(tx)
+        return tx_hash in self.by_hash
+
+    def is_over_limit(self):
+        return (self.max_count is not None and len(self.by_hash) > self.max_count) or \
+               (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+
+    def add(self, tx, tx_hash=None):
+        """
+        Add tx and evict others if pool goes over its limits.
+        :return: False if tx is already in the pool or it has the lowest priority in a full pool
+        """
+        raw = Mempool.encode_tx(tx)
+        if tx_hash is None:
+            tx_hash = hashlib.sha256(raw).digest()
+        if tx_hash in self.by_hash:
+            return False
+        self.insert(tx, tx_hash, len(raw))
+        if self.is_over_limit() and self.eviction_victim() == tx_hash:
+            self.remove(tx_hash)
+            self.rejected += 1
+            return False
+        self.evict()
+        return tx_hash in self.by_hash
+
+    def insert(self, tx, tx_hash, size):
+        self.by_hash[tx_hash] = tx
+        self.meta[tx_hash] = (self.sequence, size)
+        self.sequence += 1
+        self.total_bytes += size
+        sender = tools.tx_owner_address(tx)
+        bisect.insort(self.by_sender.setdefault(sender, []), (Mempool.tx_count(tx), tx_hash))
+        self.push_priority(sender)
+
+    def remove(self, tx_hash):
+        """
+        :return: Removed tx or None if it was not in the pool
+        """
+        tx = self.by_hash.pop(tx_hash, None)
+        if tx is None:
+            return None
+        self.total_bytes -= self.meta.pop(tx_hash)[1]
+        sender = tools.tx_owner_address(tx)
+        queue = self.by_sender[sender]
+        queue.remove((Mempool.tx_count(tx), tx_hash))
+        if len(queue) == 0:
+            del self.by_sender[sender]
+        else:
+            self.push_priority(sender)
+        return tx
+
+    def sender_priority(self, sender):
+        """
+        :return: Eviction priority of sender or None if it has no transactions in the pool
+        """
+        queue = self.by_sender.get(sender)
+        if not queue:
+            return None
+        return -len(queue), -self.meta[queue[-1][1]][0]
+
+    def push_priority(self, sender):
+        heapq.heappush(self.eviction_heap, self.sender_priority(sender) + (sender,))
+        # Rebuild when outdated entries outnumber live ones
+        if len(self.eviction_heap) > 2 * len(self.by_sender) + 64:
+            self.eviction_heap = [self.sender_priority(s) + (s,) for s in self.by_sender]
+            heapq.heapify(self.eviction_heap)
+
+    def eviction_victim(self):
+        """
+        :return: Hash of the tx with the lowest priority
+        """
+        while len(self.eviction_heap) > 0:
+            length, sequence, sender = self.eviction_heap[0]
+            if self.sender_priority(sender) == (length, sequence):
+                return self.by_sender[sender][-1][1]
+            heapq.heappop(self.eviction_heap)
+        return None
+
+    def evict(self):
+        """
+        Remove transactions with lowest priority until pool is within its limits.
+        :return: Evicted transactions
+        """
+        evicted = []
+        while self.is_over_limit():
+            tx_hash = self.eviction_victim()
+            size = self.meta[tx_hash][1]
+            evicted.append(self.remove(tx_hash))
+            self.evicted += 1
+            self.evicted_bytes += size
+        return evicted
+
+    def stats(self):
+        return {
+            'count': len(self.by_hash),
+            'bytes': self.total_bytes,
+            'senders': len(self.by_sender),
+            'max_count': self.max_count,
+            'max_bytes': self.max_bytes,
+            'evicted': self.evicted,
+            'evicted_bytes': self.evicted_bytes,
+            'rejected': self.rejected
+        }
+
+    def pending_count(self, address):
+        """
+        :return: Number of transactions sent by address that are waiting in the pool
+        """
+        return len(self.by_sender.get(address, ()))
+
+    def sender_items(self, address):
+        """
+        :return: (tx hash, tx) pairs of address ordered by count
+        """
+        return [(tx_hash, self.by_hash[tx_hash]) for _, tx_hash in self.by_sender.get(address, ())]
+
+    def txs(self):
+        """
+        :return: Transactions in arrival order
+        """
+        return list(self.by_hash.values())
+
+    def txs_by_count(self):
+        """
+        :return: Every transaction ordered by count. Per-sender queues are already
+        ordered, so they are merged instead of sorting the whole pool.
+        """
+        merged = heapq.merge(*self.by_sender.values())
+        return [self.by_hash[tx_hash] for _, tx_hash in merged]
+
+    def pop_all(self):
+        """
+        Empty the pool.
+        :return: Transactions in arrival order
+        """
+        txs = self.txs()
+        self.by_hash = OrderedDict()
+        self.by_sender = dict()
+        self.meta = dict()
+        self.eviction_heap = []
+        self.total_bytes = 0
+        return txs
@@ -1,4 +1,7 @@
+import copy
+import ctypes
 import multiprocessing
+import queue
 import random
 import time
 from multiprocessing import Process
@@ -9,12 +12,38 @@ from halocoin.blockchain import BlockchainService
 from halocoin.service import Service, threaded, lockit
 
 
+class MiningJob(ctypes.Structure):
+    """
+    Job descriptor shared between MinerService and its workers.
+    Numbers that do not fit in 64 bits are stored as 32 byte big-endian values.
+    """
+    _fields_ = [('state', ctypes.c_int),
+                ('generation', ctypes.c_uint64),
+                ('length', ctypes.c_int64),
+                ('half_hash', ctypes.c_ubyte * 32),
+                ('target', ctypes.c_ubyte * 32),
+                ('start_nonce', ctypes.c_ubyte * 32)]
+
+
 class MinerService(Service):
     """
     Simple miner service. Starts running when miner is turned on.
     Executes number of workers as specified in config.
     Workers are run as different processes. Supports multicore mining.
+    Worker processes live as long as the miner. Current work is published in a shared
+    memory job descriptor. Every publish increments a shared generation counter which workers
+    read every check_interval nonces, so stale work is abandoned within a fraction of a millisecond.
     """
+    # Number of nonces in a batch. Workers scan disjoint batches and report hashrate after each one.
+    batch_size = 500
+    # Number of nonces between reads of generation counter. 100 nonces take about 0.1-0.3 ms
+    # on a single core under both hashing rules.
+    check_interval = 100
+
+    IDLE = 0
+    MINING = 1
+    STOP = 2
+
     def __init__(self, engine):
         Service.__init__(self, "miner")
         self.engine = engine
@@ -26,6 +55,11 @@ class MinerService(Service):
         self.core_count = multiprocessing.cpu_count() if config_cores == -1 else config_cores
         self.pool = []
         self.queue = multiprocessing.Queue()
+        self.hashrates = multiprocessing.Array('d', self.core_count, lock=False)
+        self.job = multiprocessing.RawValue(MiningJob)
+        self.generation = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self.job_lock = multiprocessing.Lock()
+        self.job_event = multiprocessing.Event()
 
     def set_wallet(self, wallet):
         self.wallet = wallet
@@ -53,45 +87,106 @@ class MinerService(Service):
             return
 
         candidate_block = self.get_candidate_block()
-        self.start_workers(candidate_block)
+        generation = self.start_workers(candidate_block)
 
-        possible_blocks = []
         while self.threaded_running() and (self.db.get('length')+1) == candidate_block['length']:
             api.miner_status()
-            while not self.queue.empty():
-                possible_blocks.append(self.queue.get(timeout=0.01))
-            time.sleep(0.1)
-            if len(possible_blocks) > 0:
+            try:
+                # Blocks until a worker reports. Timeout only lets us re-check the chain.
+                job_generation, nonce = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if job_generation == generation:
+                self.pause_workers()
+                block = copy.deepcopy(candidate_block)
+                block['nonce'] = nonce
                 tools.log('Mined block')
-                tools.log(possible_blocks[:1])
-                self.blockchain.blocks_queue.put((possible_blocks[:1], 'miner'))
+                tools.log(block)
+                self.blockchain.blocks_queue.put(([block], 'miner'))
                 break
+        self.pause_workers()
+
+    def publish_job(self, state, length=0, half_hash=b'', target=b'', start_nonce=0):
+        """
+        Write a new job descriptor and bump the generation counter.
+        :return: Generation of the new job
+        """
+        if state != MinerService.MINING:
+            self.job_event.clear()
+        with self.job_lock:
+            generation = self.generation.value + 1
+            self.job.state = state
+            self.job.generation = generation
+            self.job.length = length
+            ctypes.memmove(self.job.half_hash, half_hash.rjust(32, b'\x00'), 32)
+            ctypes.memmove(self.job.target, target.rjust(32, b'\x00'), 32)
+            ctypes.memmove(self.job.start_nonce, start_nonce.to_bytes(32, 'big'), 32)
+            self.generation.value = generation
+        if state != MinerService.IDLE:
+            self.job_event.set()
+        return generation
 
     def start_workers(self, candidate_block):
-        self.close_workers()
-        for i in range(self.core_count):
-            p = Process(target=MinerService.target, args=[candidate_block, self.queue])
-            p.start()
-            self.pool.append(p)
+        """
+        Hand a new candidate block to worker processes. Processes are created only once.
+        Workers receive the half hash, not the block itself.
+        :return: Generation of the published job
+        """
+        if len(self.pool) == 0:
+            for i in range(self.core_count):
+                p = Process(target=MinerService.target,
+                            args=[self.job, self.generation, self.job_lock, self.job_event,
+                                  self.queue, self.hashrates, i, self.core_count],
+                            daemon=True)
+                p.start()
+                self.pool.append(p)
+
+        length = candidate_block['length']
+        block_without_nonce = dict(candidate_block)
+        block_without_nonce.pop('nonce', None)
+        return self.publish_job(MinerService.MINING,
+                                length=length,
+                                half_hash=tools.det_hash(block_without_nonce, length),
+                                target=bytes(candidate_block['target']),
+                                start_nonce=random.randint(0, 10000000000000000000000000000000000000000))
+
+    def pause_workers(self):
+        if len(self.pool) > 0:
+            self.publish_job(MinerService.IDLE)
 
     def close_workers(self):
+        if len(self.pool) > 0:
+            self.publish_job(MinerService.STOP)
         for p in self.pool:
-            p.terminate()
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
         self.pool = []
+        # Workers that are started later must not read the STOP job as their first job
+        self.publish_job(MinerService.IDLE)
+        for i in range(self.core_count):
+            self.hashrates[i] = 0
+
+    def hashrate(self):
+        """
+        :return: Hashes per second of each worker and their total
+        """
+        workers = list(self.hashrates)
+        return {'workers': workers, 'total': sum(workers)}
 
     def make_block(self, prev_block, txs, pubkey):
         """
         After mempool changes at 0.011c version, make block must select valid transactions.
         Mempool is mixed and not all transactions may be valid at the same time.
         Miner creates a block by adding transactions that are valid together.
-        :param prev_block:
+        :param prev_block: Header of the previous block
         :param txs:
         :param pubkey:
         :return:
         """
         leng = int(prev_block['length']) + 1
         target_ = self.blockchain.target(leng)
-        diffLength = tools.hex_sum(prev_block['diffLength'], tools.hex_invert(target_))
+        diffLength = tools.work_to_hex(prev_block['diffLength'] + tools.work(target_))
         txs = self.statedb.get_valid_txs_for_next_block(txs, leng)
         txs = [self.make_mint(pubkey)] + txs
         out = {'version': custom.version,
@@ -100,7 +195,7 @@ class MinerService(Service):
                'time': time.time(),
                'diffLength': diffLength,
                'target': target_,
-               'prevHash': tools.det_hash(prev_block)}
+               'prevHash': prev_block['hash']}
         return out
 
     def make_mint(self, pubkey):
@@ -116,7 +211,7 @@ class MinerService(Service):
                'length': 0,
                'time': time.time(),
                'target': target_,
-               'diffLength': tools.hex_invert(target_),
+               'diffLength': tools.work_to_hex(tools.work(target_)),
                'txs': [self.make_mint(pubkey)]}
         return out
 
@@ -127,31 +222,89 @@ class MinerService(Service):
         if length == -1:
             candidate_block = self.genesis(self.wallet.get_pubkey_str())
         else:
-            prev_block = self.blockchain.get_block(length)
-            candidate_block = self.make_block(prev_block, self.blockchain.tx_pool(), self.wallet.get_pubkey_str())
+            prev_block = self.blockchain.get_header(length)
+            candidate_block = self.make_block(prev_block, self.blockchain.tx_pool_by_count(), self.wallet.get_pubkey_str())
         return candidate_block
 
     @staticmethod
-    def target(_candidate_block, queue):
-        # Miner registered but no work is sent yet.
-        import copy
-        candidate_block = copy.deepcopy(_candidate_block)
-        try:
-            if candidate_block is None:
-                return
-            if 'nonce' in candidate_block:
-                candidate_block.pop('nonce')
-            halfHash = tools.det_hash(candidate_block)
-            candidate_block['nonce'] = random.randint(0, 10000000000000000000000000000000000000000)
-            current_hash = tools.det_hash({'nonce': candidate_block['nonce'], 'halfHash': halfHash})
-            while current_hash > candidate_block['target']:
-                candidate_block['nonce'] += 1
-                current_hash = tools.det_hash({'nonce': candidate_block['nonce'], 'halfHash': halfHash})
-            if current_hash <= candidate_block['target']:
-                queue.put(candidate_block)
-        except Exception as e:
-            tools.log('miner fucked up' + str(e))
-            pass
+    def search_batch(midstate, encode_nonce, start, count, target, generation=None, current_generation=None):
+        """
+        Try nonces in [start, start + count) and stop at the first hit.
+        Digest and target are fixed width big-endian bytes, so they compare like integers.
+        :param generation: Shared generation counter. If given, it is read every check_interval nonces
+        and the batch is abandoned once it is no longer current_generation.
+        :return: Found nonce or None
+        """
+        copy = midstate.copy
+        end = start + count
+        for part_start in range(start, end, MinerService.check_interval):
+            if generation is not None and generation.value != current_generation:
+                return None
+            for nonce in range(part_start, min(part_start + MinerService.check_interval, end)):
+                h = copy()
+                h.update(encode_nonce(nonce))
+                if h.digest()[0:32] <= target:
+                    return nonce
+        return None
+
+    @staticmethod
+    def target(job, generation, job_lock, job_event, queue, hashrates, index, worker_count):
+        """
+        Worker process loop. Reads the shared job descriptor whenever generation changes
+        and mines it until a nonce is found or a newer job is published.
+        IDLE jobs pause the worker, STOP ends it.
+        Nonce search kernel: preimage prefix that does not depend on nonce is hashed once.
+        Every try only copies that midstate and feeds the encoded nonce.
+        Nonce space is split into batches of batch_size. Worker at index scans batches
+        index, index + worker_count, index + 2 * worker_count... so workers never overlap.
+        Found nonces are put in queue as (generation, nonce).
+        """
+        current_generation = 0
+        mining = False
+        midstate = encode_nonce = target = None
+        batch_start = 0
+        stride = worker_count * MinerService.batch_size
+        while True:
+            try:
+                if generation.value != current_generation:
+                    with job_lock:
+                        current_generation = job.generation
+                        state = job.state
+                        length = job.length
+                        half_hash = bytes(job.half_hash)
+                        target = bytes(job.target)
+                        start_nonce = int.from_bytes(bytes(job.start_nonce), 'big')
+                    if state == MinerService.STOP:
+                        return
+                    mining = (state == MinerService.MINING)
+                    if mining:
+                        midstate, encode_nonce = tools.pow_midstate(half_hash, length)
+                        batch_start = start_nonce + index * MinerService.batch_size
+
+                if not mining:
+                    hashrates[index] = 0
+                    job_event.wait(timeout=1)
+                    if generation.value == current_generation:
+                        # Job is already solved. Wait for the next one.
+                        time.sleep(0.001)
+                    continue
+
+                start = time.time()
+                nonce = MinerService.search_batch(midstate, encode_nonce, batch_start,
+                                                  MinerService.batch_size, target,
+                                                  generation, current_generation)
+                if nonce is not None:
+                    queue.put((current_generation, nonce))
+                    mining = False
+                    continue
+                if generation.value != current_generation:
+                    # Batch was abandoned for a newer job
+                    continue
+                batch_start += stride
+                hashrates[index] = MinerService.batch_size / max(time.time() - start, 1e-6)
+            except Exception as e:
+                tools.log('miner fucked up' + str(e))
+                mining = False
 
     @staticmethod
     def is_everyone_dead(processes):
@@ -91,10 +91,11 @@ class PeerCheckService(Service):
             self.clientdb.put('known_length', greeted['length'])
 
         length = self.db.get('length')
-        diff_length = self.db.get('diffLength')
-        size = max(len(diff_length), len(greeted['diffLength']))
-        us = tools.buffer_(diff_length, size)
-        them = tools.buffer_(greeted['diffLength'], size)
+        try:
+            us = tools.hex_to_work(self.db.get('diffLength'))
+            them = tools.hex_to_work(greeted['diffLength'])
+        except (ValueError, TypeError):
+            return None
         # This is the most important peer operation part
         # We are deciding what to do with this peer. We can either
         # send them blocks, share txs or download blocks.
@@ -124,6 +125,9 @@ class PeerCheckService(Service):
             return 3
 
     def download_blocks(self, peer_ip_port, block_count_peer, length, node_id):
+        if length == -1 and self.engine.snapshots.download(peer_ip_port, self.node_id):
+            # Blocks after the snapshot are downloaded on the next check
+            return
         b = [max(0, length - 10), min(block_count_peer + 1,
                                       length + self.engine.config['peers']['download_limit'])]
         blocks = ntwrk.command(peer_ip_port, {'action': 'range_request', 'range': b}, self.node_id)
@@ -142,7 +146,8 @@ class PeerCheckService(Service):
             return -1
         new_txs = list(filter(lambda t: t not in txs, T))
         for tx in new_txs:
-            self.blockchain.tx_queue.put(tx)
+            if not self.blockchain.submit_tx(tx).getFlag():
+                break
         return 0
 
     def give_block(self, peer_ip_port, block_count_peer):
@@ -150,6 +155,11 @@ class PeerCheckService(Service):
         b = [max(block_count_peer - 5, 0), min(self.db.get('length'),
                                                block_count_peer + self.engine.config['peers']['download_limit'])]
         for i in range(b[0], b[1] + 1):
-            blocks.append(self.blockchain.get_block(i))
+            block = self.blockchain.get_block(i)
+            # Blocks before a snapshot that we were bootstrapped from are not stored
+            if block is not None:
+                blocks.append(block)
+        if len(blocks) == 0:
+            return 0
         ntwrk.command(peer_ip_port, {'action': 'push_block', 'blocks': blocks}, self.node_id)
         return 0
@@ -142,6 +142,29 @@ class PeerListenService(Service):
             counter += 1
         return out
 
+    @sync
+    def hash_request(self, hashes):
+        """
+        Blocks with given hashes. Unknown hashes are skipped.
+        At most download_limit hashes are served, same as block downloads.
+        """
+        if not isinstance(hashes, list):
+            return []
+        out = []
+        for block_hash in hashes[:self.engine.config['peers']['download_limit']]:
+            block = self.blockchain.get_block_by_hash(block_hash)
+            if block is not None:
+                out.append(block)
+        return out
+
+    @sync
+    def snapshots(self):
+        return self.engine.snapshots.available()
+
+    @sync
+    def snapshot_chunk(self, length, offset):
+        return self.engine.snapshots.read_chunk(length, offset)
+
     @sync
     def peers(self):
         return self.clientdb.get_peers()
@@ -152,7 +175,9 @@ class PeerListenService(Service):
 
     @sync
     def push_tx(self, tx):
-        self.blockchain.tx_queue.put(tx)
+        submitted = self.blockchain.submit_tx(tx)
+        if not submitted.getFlag():
+            return submitted.getData()
         return 'success'
 
     @sync
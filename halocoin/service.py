@@ -1,6 +1,8 @@
+import copy
 import queue
 import sys
 import threading
+import time
 import traceback
 
 from halocoin import tools
@@ -11,7 +13,7 @@ class NoExceptionQueue(queue.Queue):
     """
     In some cases, queue overflow is ignored. Necessary try, except blocks
     make the code less readable. This is a special queue class that
-    simply ignores overflow.
+    simply ignores overflow. put returns whether item was queued, for callers that care.
     """
 
     def __init__(self, maxsize=0):
@@ -20,8 +22,9 @@ class NoExceptionQueue(queue.Queue):
     def put(self, item, block=True, timeout=None):
         try:
             queue.Queue.put(self, item, block, timeout)
+            return True
         except queue.Full:
-            pass
+            return False
 
 
 class Service:
@@ -306,6 +309,7 @@ def threaded(func):
 
 
 locks = {}
+locks_lock = threading.Lock()
 
 
 class LockException(Exception):
@@ -313,32 +317,197 @@ class LockException(Exception):
         Exception.__init__(self, message)
 
 
-def lockit(lock_name, timeout=-1):
+class RWLock:
+    """
+    Reentrant reader/writer lock.
+    Any number of threads can hold it shared, or a single thread can hold it exclusive.
+    Exclusive holder may acquire it again in either mode. Shared holders may acquire it
+    shared again, but cannot upgrade to exclusive. Waiting writers block new readers
+    so that writers do not starve.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = {}
+        self.writer = None
+        self.write_count = 0
+        self.waiting_writers = 0
+
+    def acquire_shared(self, timeout=-1):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me or me in self.readers:
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return True
+            if not self.condition.wait_for(lambda: self.writer is None and self.waiting_writers == 0,
+                                           None if timeout < 0 else timeout):
+                return False
+            self.readers[me] = 1
+            return True
+
+    def release_shared(self):
+        me = threading.get_ident()
+        with self.condition:
+            self.readers[me] -= 1
+            if self.readers[me] == 0:
+                del self.readers[me]
+                self.condition.notify_all()
+
+    def acquire(self, timeout=-1):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.write_count += 1
+                return True
+            if me in self.readers:
+                raise LockException('Shared lock cannot be upgraded to exclusive')
+            self.waiting_writers += 1
+            try:
+                acquired = self.condition.wait_for(lambda: self.writer is None and len(self.readers) == 0,
+                                                   None if timeout < 0 else timeout)
+            finally:
+                self.waiting_writers -= 1
+            if not acquired:
+                self.condition.notify_all()
+                return False
+            self.writer = me
+            self.write_count = 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.write_count -= 1
+            if self.write_count == 0:
+                self.writer = None
+                self.condition.notify_all()
+
+
+class LockProfiler:
+    """
+    Collects statistics of lockit locks per lock name and decorated function:
+    how long callers waited, how long they held the lock, how many acquisitions
+    had to wait and which threads hold each lock right now.
+    Times are kept in histograms whose buckets are upper limits in seconds.
+    """
+    buckets = [0.0001, 0.001, 0.01, 0.1, 1, 10]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.holders = {}
+
+    def new_timing(self):
+        return {'total': 0.0, 'max': 0.0, 'histogram': [0] * (len(LockProfiler.buckets) + 1)}
+
+    def add_timing(self, timing, value):
+        timing['total'] += value
+        timing['max'] = max(timing['max'], value)
+        for i, limit in enumerate(LockProfiler.buckets):
+            if value <= limit:
+                timing['histogram'][i] += 1
+                return
+        timing['histogram'][-1] += 1
+
+    def acquired(self, lock_name, func_name, shared, wait, contended):
+        thread_name = threading.current_thread().name
+        with self.lock:
+            function_stats = self.stats.setdefault(lock_name, {}).setdefault(func_name, {
+                'calls': 0,
+                'contended': 0,
+                'wait': self.new_timing(),
+                'hold': self.new_timing()
+            })
+            function_stats['calls'] += 1
+            if contended:
+                function_stats['contended'] += 1
+            self.add_timing(function_stats['wait'], wait)
+            self.holders.setdefault(lock_name, {}).setdefault(thread_name, []).append(
+                (func_name, 'shared' if shared else 'exclusive'))
+
+    def released(self, lock_name, func_name, hold):
+        thread_name = threading.current_thread().name
+        with self.lock:
+            self.add_timing(self.stats[lock_name][func_name]['hold'], hold)
+            held = self.holders[lock_name][thread_name]
+            held.pop()
+            if len(held) == 0:
+                del self.holders[lock_name][thread_name]
+
+    def report(self):
+        with self.lock:
+            return {
+                'buckets': LockProfiler.buckets,
+                'locks': {
+                    lock_name: {
+                        'functions': copy.deepcopy(functions),
+                        'holders': {thread_name: list(held)
+                                    for thread_name, held in self.holders.get(lock_name, {}).items()}
+                    } for lock_name, functions in self.stats.items()
+                }
+            }
+
+
+lock_profiler = None
+
+
+def enable_lock_profiler():
+    global lock_profiler
+    if lock_profiler is None:
+        lock_profiler = LockProfiler()
+    return lock_profiler
+
+
+def disable_lock_profiler():
+    global lock_profiler
+    lock_profiler = None
+
+
+def get_lock(lock_name):
+    key = '__lock_{}__'.format(lock_name)
+    with locks_lock:
+        if key not in locks:
+            locks[key] = RWLock()
+        return locks[key]
+
+
+def lockit(lock_name, timeout=-1, shared=False):
     def _lockit(func):
         """
-        Decorator for any service method that needs to run in the event loop.
+        Decorator for any method that needs to hold a named lock.
+        Read-only methods should pass shared=True so that they can run together.
         Results return after execution.
         :param func: Function to be decorated
         :return: Decorated version of function
         """
+        # Named locks live as long as the process, so lock is looked up once instead of on every call.
+        mylock = get_lock(lock_name)
+        acquire = mylock.acquire_shared if shared else mylock.acquire
+        release = mylock.release_shared if shared else mylock.release
 
         def wrapper(self, *args, **kwargs):
-            global locks
-            if '__lock_{}__'.format(lock_name) in locks.keys():
-                mylock = locks['__lock_{}__'.format(lock_name)]
-            else:
-                mylock = threading.RLock()
-                locks['__lock_{}__'.format(lock_name)] = mylock
-            is_acquired = mylock.acquire(timeout=timeout)
-            if is_acquired:
-                result = func(self, *args, **kwargs)
-            else:
+            profiler = lock_profiler
+            if profiler is None:
+                if not acquire(timeout=timeout):
+                    raise LockException('Lock named {} could not be acquired in the given time'.format(lock_name))
+                try:
+                    return func(self, *args, **kwargs)
+                finally:
+                    release()
+
+            start = time.time()
+            contended = not acquire(timeout=0)
+            if contended and not acquire(timeout=timeout):
                 raise LockException('Lock named {} could not be acquired in the given time'.format(lock_name))
-            mylock.release()
-            return result
+            acquired_at = time.time()
+            profiler.acquired(lock_name, func.__qualname__, shared, acquired_at - start, contended)
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                profiler.released(lock_name, func.__qualname__, time.time() - acquired_at)
+                release()
 
         wrapper._original = func
         wrapper.thread_safe = True
         wrapper.__name__ = func.__name__
         return wrapper
-    return _lockit
\ No newline at end of file
+    return _lockit
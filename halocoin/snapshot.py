@@ -0,0 +1,358 @@
+"""
+Account state snapshots for fast bootstrap.
+
+At every multiple of custom.snapshot_interval, account state of the chain is written
+to a file together with the header of every block up to that length.
+A node with an empty chain can load a snapshot from a local file or download one from a peer.
+Instead of replaying every block, it takes headers and accounts from the snapshot and continues
+with full blocks after it.
+
+The only guarantee a snapshot gives is its checkpoint: a snapshot is loaded only if sha256 of the
+whole file is listed in custom.state_checkpoints or in snapshot section of config.
+Without transactions, neither the hash nor the proof of work of a header can be recomputed, so headers
+prove nothing by themselves. They are only checked to be a consistent chain that following blocks can extend.
+
+File layout:
+- preamble: magic, format version, length and number of accounts
+- length + 1 packed header records
+- accounts sorted by address: address, amount and count
+
+Two honest nodes at the same length must write identical files, or a checkpoint would only match
+the node that made it. cache-length of an account depends on how the node got its state, since
+accounts written by earlier versions never updated it, so it is not part of a snapshot.
+"""
+import hashlib
+import os
+import struct
+import threading
+import time
+
+from halocoin import custom, ntwrk
+from halocoin import tools
+from halocoin.blockchain import BlockchainService
+from halocoin.ntwrk import Response
+from halocoin.service import lockit
+from halocoin.state import StateDatabase
+
+
+class SnapshotStore:
+    magic = b'HALOSNAP'
+    version = 1
+    # magic, version, length, number of accounts
+    preamble_format = struct.Struct('>8sBqq')
+    # amount, count
+    account_format = struct.Struct('>qq')
+    # Size of pieces that a snapshot is sent to peers in
+    chunk_size = 256 * 1024
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.db = self.engine.db
+        self.blockchain = self.engine.blockchain
+        # path -> (modification time, size, sha256 hex)
+        self.hashes = dict()
+        self.lock = threading.Lock()
+
+    def config(self):
+        return self.engine.config.get('snapshot', {})
+
+    def directory(self):
+        return os.path.join(self.engine.working_dir, self.config().get('directory', 'snapshots'))
+
+    def path(self, length):
+        return os.path.join(self.directory(), 'snapshot_' + str(length).zfill(12) + '.bin')
+
+    def checkpoints(self):
+        """
+        :return: Trusted snapshots as length -> sha256 of file in hex
+        """
+        checkpoints = dict(custom.state_checkpoints)
+        for length, file_hash in self.config().get('checkpoints', {}).items():
+            checkpoints[int(length)] = file_hash
+        return checkpoints
+
+    @staticmethod
+    def is_due(length):
+        return custom.snapshot_interval is not None and length > 0 and length % custom.snapshot_interval == 0
+
+    @staticmethod
+    def read_exact(f, size):
+        data = f.read(size)
+        if len(data) != size:
+            raise ValueError('Snapshot file is truncated')
+        return data
+
+    @staticmethod
+    def encode_account(address, account):
+        raw = address.encode()
+        return bytes([len(raw)]) + raw + SnapshotStore.account_format.pack(account['amount'], account['count'])
+
+    @staticmethod
+    def decode_account(f):
+        """
+        :return: Address and account. cache-length is not known, so it is -1 like accounts of earlier versions.
+        """
+        address = SnapshotStore.read_exact(f, SnapshotStore.read_exact(f, 1)[0]).decode()
+        amount, count = SnapshotStore.account_format.unpack(
+            SnapshotStore.read_exact(f, SnapshotStore.account_format.size))
+        return address, {'amount': amount, 'count': count, 'cache-length': -1}
+
+    def write(self, length):
+        """
+        Write a snapshot of the chain at length. Called by the thread that has just added
+        the block at length, while its simulation is still ongoing. State is read together
+        with uncommitted changes of that simulation.
+        File keeps a .pending suffix until publish is called after the simulation is committed.
+        :return: Path of the written file or None
+        """
+        path = self.path(length) + '.pending'
+        try:
+            os.makedirs(self.directory(), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(SnapshotStore.preamble_format.pack(SnapshotStore.magic, SnapshotStore.version, length, 0))
+                for i in range(length + 1):
+                    record = self.db.get('header_' + str(i).zfill(12))
+                    if record is None:
+                        raise ValueError('Block {} is missing'.format(i))
+                    f.write(record)
+
+                # Account keys are addresses, they start with digits and sort before every other key.
+                count = 0
+                for address, record in self.db.iterate('0', ':', pending=True):
+                    if tools.is_address_valid(address):
+                        f.write(SnapshotStore.encode_account(address, StateDatabase.decode_account(record)))
+                        count += 1
+                f.seek(0)
+                f.write(SnapshotStore.preamble_format.pack(SnapshotStore.magic, SnapshotStore.version, length, count))
+            tools.log('Snapshot at {} is written with {} accounts'.format(length, count))
+            return path
+        except Exception as e:
+            tools.log('Snapshot at {} could not be written'.format(length))
+            tools.log(e)
+            self.discard([path])
+            return None
+
+    def publish(self, paths):
+        """
+        Make pending snapshots available once the blocks they were taken at are committed.
+        Only custom.snapshots_kept most recent snapshots are kept.
+        """
+        for path in paths:
+            os.replace(path, path[:-len('.pending')])
+        for length in [length for length, _ in self.lengths()][:-custom.snapshots_kept]:
+            self.discard([self.path(length)])
+
+    def discard(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def lengths(self):
+        """
+        :return: (length, path) of local snapshot files in increasing length
+        """
+        try:
+            names = os.listdir(self.directory())
+        except OSError:
+            return []
+        out = []
+        for name in names:
+            if name.startswith('snapshot_') and name.endswith('.bin'):
+                try:
+                    out.append((int(name[len('snapshot_'):-len('.bin')]), os.path.join(self.directory(), name)))
+                except ValueError:
+                    continue
+        return sorted(out)
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.hashes.get(path)
+            if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+                return cached[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        with self.lock:
+            self.hashes[path] = (stat.st_mtime, stat.st_size, h.hexdigest())
+        return h.hexdigest()
+
+    def available(self):
+        """
+        :return: Local snapshots as dicts of length, sha256 of file and size in bytes
+        """
+        out = []
+        for length, path in self.lengths():
+            try:
+                out.append({'length': length, 'hash': self.file_hash(path), 'size': os.path.getsize(path)})
+            except OSError:
+                continue
+        return out
+
+    def read_chunk(self, length, offset):
+        """
+        :return: At most chunk_size bytes of snapshot at length, starting from offset. None if there is no such snapshot.
+        """
+        if not isinstance(length, int) or not isinstance(offset, int) or offset < 0:
+            return None
+        try:
+            with open(self.path(length), 'rb') as f:
+                f.seek(offset)
+                return f.read(SnapshotStore.chunk_size)
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def download(self, peer_ip_port, node_id):
+        """
+        Download the longest trusted snapshot that peer has and load it.
+        Size of a snapshot is what the peer says it is, so it is capped by max_size and
+        the download stops as soon as the peer sends more than that. File is hashed while it
+        arrives and is not loaded unless the hash matches the checkpoint.
+        :return: Whether a snapshot was loaded
+        """
+        snapshots = ntwrk.command(peer_ip_port, {'action': 'snapshots'}, node_id)
+        if not isinstance(snapshots, list):
+            return False
+        checkpoints = self.checkpoints()
+        max_size = self.config().get('max_size', custom.snapshot_max_size)
+        trusted = [s for s in snapshots if isinstance(s, dict) and
+                   s.get('length') in checkpoints and checkpoints[s['length']] == s.get('hash') and
+                   isinstance(s.get('size'), int) and 0 < s['size'] <= max_size]
+        if len(trusted) == 0:
+            return False
+        snapshot = max(trusted, key=lambda s: s['length'])
+
+        path = self.path(snapshot['length']) + '.download'
+        try:
+            os.makedirs(self.directory(), exist_ok=True)
+            h = hashlib.sha256()
+            with open(path, 'wb') as f:
+                offset = 0
+                while offset < snapshot['size']:
+                    chunk = ntwrk.command(peer_ip_port, {'action': 'snapshot_chunk',
+                                                         'length': snapshot['length'],
+                                                         'offset': offset}, node_id)
+                    if not isinstance(chunk, bytes) or len(chunk) == 0:
+                        tools.log('Snapshot download from {} was interrupted'.format(peer_ip_port))
+                        return False
+                    if offset + len(chunk) > snapshot['size']:
+                        tools.log('{} sent more than the size of snapshot'.format(peer_ip_port))
+                        return False
+                    h.update(chunk)
+                    f.write(chunk)
+                    offset += len(chunk)
+            if h.hexdigest() != checkpoints[snapshot['length']]:
+                tools.log('Snapshot downloaded from {} does not match the checkpoint'.format(peer_ip_port))
+                return False
+            result = self.load(path)
+            tools.log(result.getData())
+            if result.getFlag():
+                os.replace(path, self.path(snapshot['length']))
+            return result.getFlag()
+        finally:
+            self.discard([path])
+
+    @lockit('write_kvstore')
+    def load(self, path):
+        """
+        Bootstrap an empty chain from a snapshot file.
+        File must be a trusted checkpoint, that is the only guarantee. Headers are checked for
+        order, links to previous headers, cumulative difficulty and targets, so that a broken file
+        is not loaded and blocks after the snapshot are validated against sound headers.
+        Blocks up to the snapshot have no transactions stored. They cannot be rolled back or served to peers.
+        :param path: Snapshot file
+        :return: Response
+        """
+        if self.db.get('length') != -1:
+            return Response(False, 'Snapshots can only be loaded into an empty chain')
+        try:
+            file_hash = self.file_hash(path)
+            f = open(path, 'rb')
+        except OSError:
+            return Response(False, 'Snapshot file cannot be read')
+
+        with f:
+            try:
+                magic, version, length, count = SnapshotStore.preamble_format.unpack(
+                    SnapshotStore.read_exact(f, SnapshotStore.preamble_format.size))
+            except (ValueError, struct.error):
+                return Response(False, 'Not a snapshot file')
+            if magic != SnapshotStore.magic or version != SnapshotStore.version:
+                return Response(False, 'Not a snapshot file')
+            if self.checkpoints().get(length) != file_hash:
+                return Response(False, 'Snapshot at {} is not a trusted checkpoint'.format(length))
+
+            self.db.simulate()
+            committed = False
+            try:
+                top = self.import_headers(f, length)
+                self.import_accounts(f, count)
+                if len(f.read(1)) > 0:
+                    raise ValueError('Snapshot file has trailing data')
+                self.db.put('length', length)
+                self.db.put('diffLength', tools.work_to_hex(top['diffLength']))
+                self.db.put('snapshot_length', length)
+                self.db.commit()
+                committed = True
+            except (ValueError, struct.error) as e:
+                return Response(False, str(e))
+            except Exception as e:
+                tools.log(e)
+                return Response(False, 'Snapshot could not be loaded')
+            finally:
+                # A simulation left open would swallow every later commit of this thread
+                if not committed:
+                    self.db.rollback()
+                    self.blockchain.retarget.block_removed(0)
+        return Response(True, 'Chain is bootstrapped from snapshot at {}'.format(length))
+
+    def import_headers(self, f, length):
+        """
+        Read headers 0...length and check that they form a consistent chain. Each header is
+        written before the next one is checked, since target of a block depends on headers before it.
+        :return: Header at length
+        """
+        previous = None
+        for i in range(length + 1):
+            record = SnapshotStore.read_exact(f, BlockchainService.header_format.size)
+            header = BlockchainService.unpack_header(record)
+
+            if header['length'] != i:
+                raise ValueError('Header {} is out of order'.format(i))
+            if header['target'] <= 0:
+                raise ValueError('Header {} has an invalid target'.format(i))
+            expected_work = tools.work(header['target'])
+            if previous is not None:
+                expected_work += previous['diffLength']
+                if header['prevHash'] != previous['hash']:
+                    raise ValueError('Header {} does not follow the previous one'.format(i))
+            if header['diffLength'] != expected_work:
+                raise ValueError('Header {} has wrong cumulative difficulty'.format(i))
+            if header['time'] > time.time() + 60 * 6:
+                raise ValueError('Header {} is coming from the future'.format(i))
+
+            self.db.put('length', i - 1)
+            if tools.target_to_int(self.blockchain.target(i)) != header['target']:
+                raise ValueError('Header {} has wrong target'.format(i))
+
+            self.db.put('header_' + str(i).zfill(12), record)
+            self.db.put('height_' + header['hash'].hex(), i)
+            self.blockchain.retarget.block_added(header)
+            previous = header
+        return previous
+
+    def import_accounts(self, f, count):
+        last_address = None
+        for _ in range(count):
+            address, account = SnapshotStore.decode_account(f)
+            if not tools.is_address_valid(address):
+                raise ValueError('Snapshot includes an invalid address')
+            if last_address is not None and address <= last_address:
+                raise ValueError('Accounts in snapshot are not sorted')
+            if account['amount'] < 0 or account['count'] < 0:
+                raise ValueError('Snapshot includes an invalid account')
+            self.db.put(address, StateDatabase.encode_account(account))
+            last_address = address
@@ -1,6 +1,8 @@
-import copy
+import multiprocessing
+import struct
+import threading
 
-from halocoin import tools
+from halocoin import tools, custom, verification
 from halocoin.service import lockit
 
 
@@ -12,20 +14,56 @@ class StateDatabase:
     A state can be simulated against a transaction, multiple transactions or blocks.
     These simulations can be recorded or removed upon the result of simulation.
     Simulations are basically not committed database changes.
+
+    Transactions of an address are not kept in its account. They are indexed under
+    txindex_<address>_<height>_<tx index> keys, so accounts stay small no matter how busy an address is.
+
+    Accounts are stored as fixed size records of amount, count and cache-length, which is
+    the length of the last block that changed the account. Callers still see dicts.
+    While a block is applied, every account it touches is loaded into a staging dict once,
+    transactions are applied to that dict and each account is written once per block.
+
+    Transactions of a block are split into groups that touch disjoint sets of addresses.
+    Groups do not affect each other, so they can be applied in a process pool.
+    Within a group transactions keep their serial order, which makes the result
+    identical to applying the whole block serially.
     """
-    default_account = {
-        'amount': 0,
-        'count': 0,
-        'cache-length': -1,
-        'tx_blocks': []
-    }
+    # amount, count, cache-length
+    account_format = struct.Struct('>qqq')
 
     def __init__(self, engine):
         self.engine = engine
         self.db = self.engine.db
         self.blockchain = self.engine.blockchain
+        self.pool = None
+        self.pool_lock = threading.Lock()
 
-    @lockit('kvstore')
+    @staticmethod
+    def new_account():
+        return {'amount': 0, 'count': 0, 'cache-length': -1}
+
+    @staticmethod
+    def encode_account(account):
+        return StateDatabase.account_format.pack(account['amount'], account['count'], account['cache-length'])
+
+    @staticmethod
+    def decode_account(record):
+        """
+        :param record: Stored account. Accounts written before fixed size records are dicts.
+        :return: Account dict or None
+        """
+        if record is None:
+            return None
+        if isinstance(record, dict):
+            return {'amount': record['amount'], 'count': record['count'],
+                    'cache-length': record.get('cache-length', -1)}
+        amount, count, cache_length = StateDatabase.account_format.unpack(record)
+        return {'amount': amount, 'count': count, 'cache-length': cache_length}
+
+    def put_account(self, address, account):
+        self.db.put(address, StateDatabase.encode_account(account))
+
+    @lockit('kvstore', shared=True)
     def get_account(self, address, apply_tx_pool=False):
         def update_account_with_txs(address, account, txs):
             for tx in txs:
@@ -38,18 +76,14 @@ class StateDatabase:
 
             return account
 
-        if self.db.exists(address):
-            account = self.db.get(address)
-        else:
-            account = copy.deepcopy(StateDatabase.default_account)
+        account = StateDatabase.decode_account(self.db.get(address))
+        if account is None:
+            account = StateDatabase.new_account()
 
         if apply_tx_pool:
             txs = self.blockchain.tx_pool()
             account = update_account_with_txs(address, account, txs)
 
-        if 'tx_blocks' not in account:
-            account['tx_blocks'] = []
-
         return account
 
     @lockit('kvstore')
@@ -60,39 +94,212 @@ class StateDatabase:
     def update_account(self, address, new_account):
         if new_account['amount'] < 0:
             return False
-        self.db.put(address, new_account)
+        self.put_account(address, new_account)
         return True
 
     def update_database_with_tx(self, tx, block_length, count_pool=False):
+        addresses = StateDatabase.tx_addresses(tx)
+        accounts = {address: self.get_account(address) for address in addresses}
+        pending = 0
+        if count_pool and tx['type'] == 'spend':
+            pending = self.blockchain.tx_pool_count(addresses[0])
+        if not StateDatabase.apply_tx(accounts, tx, block_length, pending):
+            return False
+        for address in addresses:
+            self.update_account(address, accounts[address])
+        return True
+
+    @staticmethod
+    def tx_addresses(tx):
+        """
+        :return: Addresses whose accounts tx changes, sender first
+        """
+        if tx['type'] == 'spend':
+            return [tools.tx_owner_address(tx), tx['to']]
+        return [tools.tx_owner_address(tx)]
+
+    @staticmethod
+    def apply_tx(accounts, tx, block_length, pending=0):
+        """
+        Apply tx to account dicts. accounts must hold every address in tx_addresses(tx).
+        Nothing is changed if tx is not valid.
+        :param pending: Number of transactions of sender that come before tx but are not applied
+        :return: Whether tx is valid
+        """
         send_address = tools.tx_owner_address(tx)
-        send_account = self.get_account(send_address)
+        send_account = dict(accounts[send_address])
 
         if tx['type'] == 'mint':
             send_account['amount'] += tools.block_reward(block_length)
-            self.update_account(send_address, send_account)
+            send_account['cache-length'] = block_length
+            accounts[send_address] = send_account
         elif tx['type'] == 'spend':
-            if tx['count'] != self.known_tx_count(send_address, count_pool=count_pool):
+            if tx['count'] != send_account['count'] + pending:
                 return False
 
             recv_address = tx['to']
-            recv_account = self.get_account(recv_address)
+            recv_account = dict(accounts[recv_address])
 
             send_account['amount'] -= tx['amount']
             send_account['count'] += 1
-            send_account['tx_blocks'].append(block_length)
+            send_account['cache-length'] = block_length
 
             recv_account['amount'] += tx['amount']
-            recv_account['tx_blocks'].append(block_length)
+            recv_account['cache-length'] = block_length
 
             if (recv_account['amount'] < 0) or (send_account['amount'] < 0):
                 return False
 
-            self.update_account(send_address, send_account)
-            self.update_account(recv_address, recv_account)
+            accounts[send_address] = send_account
+            accounts[recv_address] = recv_account
         else:
             return False
         return True
 
+    @staticmethod
+    def partition(txs):
+        """
+        Split transactions into groups that touch disjoint sets of addresses.
+        Groups are ordered by their first transaction and keep the order of txs inside.
+        :param txs: List of (tx index, tx)
+        :return: List of groups, each a list of (tx index, tx)
+        """
+        parent = {}
+
+        def find(address):
+            root = address
+            while parent[root] != root:
+                root = parent[root]
+            while parent[address] != root:
+                parent[address], address = root, parent[address]
+            return root
+
+        for _, tx in txs:
+            addresses = StateDatabase.tx_addresses(tx)
+            for address in addresses:
+                parent.setdefault(address, address)
+            first = find(addresses[0])
+            for address in addresses[1:]:
+                root = find(address)
+                if root != first:
+                    parent[root] = first
+
+        groups = {}
+        for item in txs:
+            root = find(StateDatabase.tx_addresses(item[1])[0])
+            groups.setdefault(root, []).append(item)
+        return list(groups.values())
+
+    def apply_groups(self, accounts, groups, block_length, min_parallel_txs=None):
+        """
+        Apply groups of a block to staged accounts.
+        :param min_parallel_txs: Blocks with at least this many transactions use process pool.
+        None means custom.parallel_apply_min_txs.
+        :return: Whether every transaction is valid
+        """
+        if min_parallel_txs is None:
+            min_parallel_txs = custom.parallel_apply_min_txs
+        tx_count = sum(len(group) for group in groups)
+        if min_parallel_txs is None or tx_count < min_parallel_txs or len(groups) < 2:
+            for group in groups:
+                if apply_group((accounts, group, block_length)) is None:
+                    return False
+            return True
+
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(multiprocessing.cpu_count())
+            worker_count = self.pool._processes
+            # Largest groups first, each to the least loaded chunk
+            chunks = [([], {}) for _ in range(worker_count)]
+            loads = [0] * worker_count
+            for group in sorted(groups, key=len, reverse=True):
+                i = loads.index(min(loads))
+                chunks[i][0].extend(group)
+                for _, tx in group:
+                    for address in StateDatabase.tx_addresses(tx):
+                        chunks[i][1][address] = accounts[address]
+                loads[i] += len(group)
+            results = self.pool.map(apply_group, [(chunk_accounts, chunk_txs, block_length)
+                                                  for chunk_txs, chunk_accounts in chunks if len(chunk_txs) > 0])
+        for result in results:
+            if result is None:
+                return False
+            accounts.update(result)
+        return True
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+    @staticmethod
+    def tx_index_key(address, length, tx_index):
+        return 'txindex_' + address + '_' + str(length).zfill(12) + '_' + str(tx_index).zfill(6)
+
+    @staticmethod
+    def tx_index_entries(tx):
+        """
+        :return: (address, role) pairs that tx is indexed under
+        """
+        if tx['type'] == 'mint':
+            return [(tools.tx_owner_address(tx), 'mint')]
+        return [(tools.tx_owner_address(tx), 'send'), (tx['to'], 'recv')]
+
+    def index_block(self, block):
+        for tx_index, tx in enumerate(block['txs']):
+            for address, role in StateDatabase.tx_index_entries(tx):
+                self.db.put(StateDatabase.tx_index_key(address, block['length'], tx_index), role)
+
+    def unindex_block(self, block):
+        for tx_index, tx in enumerate(block['txs']):
+            for address, _ in StateDatabase.tx_index_entries(tx):
+                self.db.delete(StateDatabase.tx_index_key(address, block['length'], tx_index))
+
+    def index_transactions(self):
+        """
+        Chains that were stored before transaction index existed keep transactions
+        only in blocks. Build their index once.
+        """
+        if self.db.get('tx_index_built'):
+            return
+        length = self.db.get('length')
+        if length is not None:
+            self.db.simulate()
+            for i in range(length + 1):
+                block = self.blockchain.get_block(i)
+                if block is not None:
+                    self.index_block(block)
+            self.db.commit()
+        self.db.put('tx_index_built', True)
+
+    def tx_history(self, address, limit, before=None, roles=('mint', 'send', 'recv')):
+        """
+        Transactions of address, newest first.
+        :param limit: Maximum number of transactions to return
+        :param before: Cursor returned by an earlier call. Only older transactions are returned.
+        :param roles: Roles of address in transactions that are returned
+        :return: List of (length, tx index, role, tx) and cursor for the next page or None
+        """
+        start = 'txindex_' + address + '_'
+        stop = start + before if before is not None else start + '~'
+        history = []
+        blocks = {}
+        cursor = None
+        for key, role in self.db.iterate(start, stop, reverse=True):
+            if role not in roles:
+                continue
+            if len(history) == limit:
+                return history, cursor
+            cursor = key[len(start):]
+            length, tx_index = [int(part) for part in cursor.split('_')]
+            if length not in blocks:
+                blocks[length] = self.blockchain.get_block(length)
+            history.append((length, tx_index, role, blocks[length]['txs'][tx_index]))
+        return history, None
+
     def update_database_with_block(self, block):
         """
         This method should only be called after block passes every check.
@@ -101,20 +308,46 @@ class StateDatabase:
         :return: Whether it was a successfull add operation
         """
 
-        txs = sorted(block['txs'], key=lambda x: x['count'] if 'count' in x else -1)
-
-        for tx in txs:
-            result = self.update_database_with_tx(tx, block['length'])
-            if not result:
+        txs = sorted(enumerate(block['txs']), key=lambda x: x[1]['count'] if 'count' in x[1] else -1)
+        for _, tx in txs:
+            if tx['type'] not in ('mint', 'spend'):
                 return False
 
+        # Stored values of touched accounts before this block, for rollback. None means no account yet.
+        undo = {}
+        accounts = {}
+        for _, tx in txs:
+            for address in StateDatabase.tx_addresses(tx):
+                if address not in undo:
+                    undo[address] = self.db.get(address)
+                    accounts[address] = StateDatabase.decode_account(undo[address]) or StateDatabase.new_account()
+
+        if not self.apply_groups(accounts, StateDatabase.partition(txs), block['length']):
+            return False
+
+        for address, account in accounts.items():
+            self.put_account(address, account)
+        self.index_block(block)
+        self.db.put(StateDatabase.undo_key(block['length']), undo)
+        # Blocks deeper than undo_depth are not expected to be rolled back. If they are, they are replayed.
+        if block['length'] >= custom.undo_depth:
+            self.db.delete(StateDatabase.undo_key(block['length'] - custom.undo_depth))
         return True
 
+    @staticmethod
+    def undo_key(length):
+        return 'undo_' + str(length).zfill(12)
+
     def get_valid_txs_for_next_block(self, txs, new_length):
         txs = sorted(txs, key=lambda x: x['count'] if 'count' in x else -1)
         valid_txs = []
         self.db.simulate()
         for tx in txs:
+            if tx['type'] == 'spend':
+                # Signature hashing rule may have changed since tx entered the pool
+                task = verification.signature_task(tx, new_length)
+                if task is None or not verification.verify_cached(task):
+                    continue
             result = self.update_database_with_tx(tx, new_length)
             if result:
                 valid_txs.append(tx)
@@ -136,33 +369,52 @@ class StateDatabase:
             # Block is not at the top the chain
             return False
 
+        self.unindex_block(block)
+        undo = self.db.get(StateDatabase.undo_key(block['length']))
+        if undo is not None:
+            # Restore accounts to what they were before this block
+            for address, account in undo.items():
+                self.db.put(address, account)
+            self.db.delete(StateDatabase.undo_key(block['length']))
+            return True
+
         for tx in block['txs']:
             tx_owner_address = tools.tx_owner_address(tx)
             owner_account = self.get_account(tx_owner_address)
             if tx['type'] == 'mint':
                 owner_account['amount'] -= tools.block_reward(block['length'])
-                self.db.put(tx_owner_address, owner_account)
+                self.put_account(tx_owner_address, owner_account)
             elif tx['type'] == 'spend':
                 owner_account['amount'] += tx['amount']
                 owner_account['count'] -= 1
-                owner_account['tx_blocks'].remove(block['length'])
 
-                receiver_account = self.db.get(tx['to'])
+                receiver_account = self.get_account(tx['to'])
                 receiver_account['amount'] -= tx['amount']
-                receiver_account['tx_blocks'].remove(block['length'])
 
-                self.db.put(tx_owner_address, owner_account)
-                self.db.put(tx['to'], receiver_account)
+                self.put_account(tx_owner_address, owner_account)
+                self.put_account(tx['to'], receiver_account)
 
-    @lockit('kvstore')
+    @lockit('kvstore', shared=True)
     def known_tx_count(self, address, count_pool=True, txs_in_pool=None):
         # Returns the number of transactions that pubkey has broadcast.
-        def number_of_unconfirmed_txs(_address):
-            return len(list(filter(lambda t: _address == tools.tx_owner_address(t), txs_in_pool)))
-
         account = self.get_account(address)
         surplus = 0
         if count_pool:
-            txs_in_pool = self.blockchain.tx_pool()
-            surplus += number_of_unconfirmed_txs(address)
-        return account['count'] + surplus
\ No newline at end of file
+            if txs_in_pool is None:
+                surplus += self.blockchain.tx_pool_count(address)
+            else:
+                surplus += len([t for t in txs_in_pool if address == tools.tx_owner_address(t)])
+        return account['count'] + surplus
+
+
+def apply_group(args):
+    """
+    Apply transactions to accounts in order. Runs in pool workers for big blocks.
+    :param args: (accounts, list of (tx index, tx), block length)
+    :return: Changed accounts or None if a transaction is not valid
+    """
+    accounts, txs, block_length = args
+    for _, tx in txs:
+        if not StateDatabase.apply_tx(accounts, tx, block_length):
+            return None
+    return accounts
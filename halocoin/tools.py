@@ -1,14 +1,17 @@
 import copy
+import functools
 import hashlib
 import logging
 import os
 import random
 import struct
+import threading
 import time
+from collections import OrderedDict
 
 import yaml
 
-from halocoin import custom
+from halocoin import custom, encoding
 
 alphabet = '123456789abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ'
 
@@ -43,6 +46,41 @@ def log(message):
         logging.info('{}'.format(message))
 
 
+def bounded_memo(size, key):
+    """
+    Memoize a function in an LRU cache of at most size entries.
+    key maps the arguments to a hashable cache key. Calls whose key is None are not cached.
+    Exceptions are not cached. Undecorated function is available as __wrapped__.
+    """
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            try:
+                k = key(*args)
+                hash(k)
+            except TypeError:
+                k = None
+            if k is None:
+                return func(*args)
+            with lock:
+                if k in cache:
+                    cache.move_to_end(k)
+                    return cache[k]
+            value = func(*args)
+            with lock:
+                cache[k] = value
+                while len(cache) > size:
+                    cache.popitem(last=False)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
 def tx_owner_address(tx):
     return make_address(tx['pubkeys'], len(tx['signatures']))
 
@@ -61,15 +99,75 @@ def block_reward(length):
     return int(b)
 
 
-def det_hash(x):
-    """Deterministically takes sha256 of dict, list, int, or string."""
+def is_canonical_encoding_active(length):
+    return length is not None and length >= custom.canonical_encoding_height
+
+
+def det_hash(x, length=None):
+    """
+    Deterministically takes sha256 of dict, list, int, or string.
+    Objects that belong to a block at or above custom.canonical_encoding_height
+    are serialized with canonical binary encoding. Others use yaml, so that
+    earlier chain keeps verifying under the old rule.
+    :param x: Object to hash
+    :param length: Length of the block that x belongs to. None means the old rule.
+    :return: 32 bytes digest
+    """
+    if is_canonical_encoding_active(length):
+        return hashlib.sha384(encoding.encode(x)).digest()[0:32]
     return hashlib.sha384(yaml.dump(x).encode()).digest()[0:32]
 
 
+def signature_encodings(length):
+    """
+    Hashing rules that signatures of a tx are accepted under when it goes into the block at length.
+    True stands for canonical encoding and False for yaml. Rule of the block itself comes first.
+    A tx is signed for the next block, but it may end up in a later or, after a reorg, an earlier one.
+    Around canonical_encoding_height both rules are accepted so that it stays valid across the switch.
+    """
+    canonical = is_canonical_encoding_active(length)
+    if length is not None and \
+            abs(length - custom.canonical_encoding_height) < custom.signature_transition_blocks:
+        return canonical, not canonical
+    return canonical,
+
+
+def tx_signing_messages(tx, length):
+    """
+    :param tx: Transaction without its signatures
+    :param length: Length of the block that tx is going into
+    :return: Hashes of tx that its signatures are accepted over
+    """
+    return tuple(det_hash(tx, custom.canonical_encoding_height if canonical else None)
+                 for canonical in signature_encodings(length))
+
+
+def pow_midstate(half_hash, length):
+    """
+    Proof of work preimage is {'nonce': nonce, 'halfHash': half_hash}. Under both hashing rules
+    nonce comes last in the serialization, so everything before it can be hashed once.
+    Hash of a nonce is then midstate.copy() updated with nonce_encoder(nonce).
+    :param half_hash: Hash of the block without nonce
+    :param length: Length of the block
+    :return: (midstate, nonce_encoder)
+    """
+    if is_canonical_encoding_active(length):
+        return hashlib.sha384(encoding.pow_prefix(half_hash)), encoding.encode_int
+
+    dumped = yaml.dump({'nonce': 0, 'halfHash': half_hash})
+    if not dumped.endswith('nonce: 0\n'):
+        raise ValueError('Unexpected yaml layout for nonce preimage')
+
+    def nonce_encoder(nonce):
+        return (str(nonce) + '\n').encode()
+
+    return hashlib.sha384(dumped[:-2].encode()), nonce_encoder
+
+
 def hash_without_nonce(block):
     a = copy.deepcopy(block)
     a.pop('nonce')
-    return {'nonce': block['nonce'], 'halfHash': det_hash(a)}
+    return {'nonce': block['nonce'], 'halfHash': det_hash(a, block['length'])}
 
 
 def base58_encode(num):
@@ -97,6 +195,14 @@ def is_address_valid(address):
     return True
 
 
+def pubkeys_key(pubkeys, n):
+    # bytearray and bytes pubkeys hash to different addresses, so only exact types are cached
+    if not isinstance(pubkeys, (list, tuple)) or not all(type(p) in (str, bytes) for p in pubkeys):
+        return None
+    return type(pubkeys), tuple((type(p), p) for p in pubkeys), type(n), n
+
+
+@bounded_memo(100000, pubkeys_key)
 def make_address(pubkeys, n):
     """
     n is the number of pubkeys required to spend from this address.
@@ -124,19 +230,41 @@ def median(mylist):
     return sorted(mylist)[len(mylist) // 2]
 
 
-def hex_sum(a, b):
-    # Sum of numbers expressed as hexidecimal strings
-    if isinstance(a, bytearray):
-        a = a.hex()
-        b = b.hex()
-    return buffer_(format(int(a, 16) + int(b, 16), 'x'), 64)
+# Targets are 256 bit numbers. Work is computed over double-size to reduce information leakage.
+max_work_numerator = 2 ** 512 - 1
+
+
+def target_to_int(target):
+    """
+    Blocks carry targets as big-endian bytearrays. Everything else works on integers.
+    """
+    if isinstance(target, int):
+        return target
+    if isinstance(target, str):
+        return int(target, 16)
+    return int.from_bytes(bytes(target), 'big')
+
+
+def int_to_target(n):
+    return bytearray(n.to_bytes(max(32, (n.bit_length() + 7) // 8), 'big'))
+
+
+def work(target):
+    """
+    Expected number of hashes to find a block under target.
+    Cumulative work of a chain is kept in blocks as diffLength.
+    """
+    return max_work_numerator // target_to_int(target)
+
+
+def work_to_hex(n):
+    return buffer_(format(n, 'x'), 64)
 
 
-def hex_invert(n):
-    # Use double-size for division, to reduce information leakage.
-    if isinstance(n, bytearray):
-        n = n.hex()
-    return buffer_(format(int('f' * 128, 16) // int(n, 16), 'x'), 64)
+def hex_to_work(s):
+    if s is None or s == '':
+        return 0
+    return int(s, 16)
 
 
 def encrypt(key, content, chunksize=64 * 1024):
@@ -191,12 +319,20 @@ def decrypt(key, content, chunksize=24 * 1024):
     return outfile.getvalue()
 
 
-def signature_verify(message, signature, pubkey):
+@bounded_memo(10000, lambda pubkey: pubkey)
+def verifying_key(pubkey):
+    """
+    Parsing a pubkey decompresses a curve point, which is slow in pure python ecdsa.
+    Parsed keys are kept for pubkeys that are seen again.
+    """
     from ecdsa import VerifyingKey, SECP256k1
-    if isinstance(pubkey, str):
-        pubkey = VerifyingKey.from_string(pubkey, curve=SECP256k1)
-    elif isinstance(pubkey, bytes):
-        pubkey = VerifyingKey.from_string(pubkey, curve=SECP256k1)
+    return VerifyingKey.from_string(pubkey, curve=SECP256k1)
+
+
+def signature_verify(message, signature, pubkey):
+    from ecdsa import VerifyingKey
+    if isinstance(pubkey, (str, bytes)):
+        pubkey = verifying_key(pubkey)
 
     if isinstance(pubkey, VerifyingKey):
         try:
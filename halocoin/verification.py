@@ -0,0 +1,251 @@
+"""
+Signature verification for transactions and batches of blocks.
+ECDSA verification dominates block validation. Signatures of a batch of blocks
+do not depend on each other or on the chain state, so they are verified up front
+in a process pool before blocks are applied.
+"""
+import multiprocessing
+import threading
+from collections import OrderedDict
+
+from halocoin import tools
+
+
+def signature_task(tx, length=None):
+    """
+    Extract what is needed to verify signatures of a spend transaction.
+    :param tx: Transaction
+    :param length: Length of the block that tx is going into. Decides the hashing rules for signatures.
+    :return: (messages, signatures, pubkeys) or None if tx is not structurally signed.
+    Signatures must match any one of the messages.
+    """
+    if 'signatures' not in tx or not isinstance(tx['signatures'], (list,)):
+        tools.log('no signatures')
+        return None
+    if 'pubkeys' not in tx or not isinstance(tx['pubkeys'], (list,)):
+        tools.log('no pubkeys')
+        return None
+    if len(tx['pubkeys']) == 0:
+        tools.log('pubkey error')
+        return None
+    if len(tx['signatures']) > len(tx['pubkeys']):
+        tools.log('there are more signatures than required')
+        return None
+
+    tx_copy = dict(tx)
+    tx_copy.pop('signatures')
+    msgs = tools.tx_signing_messages(tx_copy, length)
+    return msgs, list(tx['signatures']), list(tx['pubkeys'])
+
+
+def sigs_match(_sigs, _pubs, msg):
+    pubs = list(_pubs)
+    sigs = list(_sigs)
+
+    def match(sig, pubs, msg):
+        for p in pubs:
+            if tools.signature_verify(msg, sig, p):
+                return {'bool': True, 'pub': p}
+        return {'bool': False}
+
+    for sig in sigs:
+        a = match(sig, pubs, msg)
+        if not a['bool']:
+            return False
+        sigs.remove(sig)
+        pubs.remove(a['pub'])
+    return True
+
+
+def verify_task(task):
+    msgs, sigs, pubs = task
+    return any(sigs_match(sigs, pubs, msg) for msg in msgs)
+
+
+class SignatureCache:
+    """
+    Bounded LRU set of signature tasks that were verified successfully.
+    A tx is verified when it enters mempool, again when it arrives in a block and
+    again every time it is re-queued after a block is added or deleted.
+    Only the first one needs ECDSA work.
+    Key is the accepted messages and the signatures. Messages are hashes of the tx
+    without its signatures, so they already cover pubkeys and every other field.
+    Failures are not cached.
+    """
+    size = 50000
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(task):
+        msgs, sigs, pubs = task
+        try:
+            key = (tuple(bytes(msg) for msg in msgs),
+                   tuple(bytes(sig) if isinstance(sig, (bytes, bytearray)) else sig for sig in sigs))
+            hash(key)
+            return key
+        except TypeError:
+            return None
+
+    def contains(self, task):
+        key = SignatureCache.key(task)
+        with self.lock:
+            if key is not None and key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, task):
+        key = SignatureCache.key(task)
+        if key is None:
+            return
+        with self.lock:
+            self.entries[key] = True
+            self.entries.move_to_end(key)
+            while len(self.entries) > SignatureCache.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+signature_cache = SignatureCache()
+
+
+def verify_cached(task):
+    """
+    Verify a signature task unless it was verified before.
+    """
+    if signature_cache.contains(task):
+        return True
+    if verify_task(task):
+        signature_cache.add(task)
+        return True
+    return False
+
+
+# Set in pool workers. When a batch fails, remaining tasks of that batch are skipped.
+abort_event = None
+
+
+def init_worker(event):
+    global abort_event
+    abort_event = event
+
+
+def verify_indexed_task(indexed_task):
+    index, (_, task) = indexed_task
+    if abort_event is not None and abort_event.is_set():
+        return index, None
+    return index, verify_task(task)
+
+
+class SignatureVerifier:
+    """
+    Verifies all signatures of a batch of blocks across a process pool.
+    Pool is created on first use and lives until close is called.
+    Small batches, like a single mined block, are verified in the calling thread
+    since sending them to the pool costs more than verifying them.
+    Tasks found in signature_cache are not verified again.
+    """
+    # Batches with fewer tasks than this are not sent to the pool
+    min_pool_tasks = 16
+    chunk_size = 8
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = None
+        self.abort_event = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def collect(blocks):
+        """
+        :return: List of (block index, task) and per-block results that are already known.
+        A block with a tx that is not structurally signed is known to be invalid.
+        Blocks after it cannot be added anyway, so they are not collected.
+        """
+        tasks = []
+        results = [True] * len(blocks)
+        for i, block in enumerate(blocks):
+            for tx in block.get('txs', []):
+                if not isinstance(tx, dict) or tx.get('type') != 'spend':
+                    continue
+                task = signature_task(tx, block['length'])
+                if task is None:
+                    results[i] = False
+                    for j in range(i + 1, len(blocks)):
+                        results[j] = None
+                    return tasks, results
+                if not signature_cache.contains(task):
+                    tasks.append((i, task))
+        return tasks, results
+
+    def verify_blocks(self, blocks):
+        """
+        Verify signatures of every spend transaction in blocks.
+        Stops at the first bad signature.
+        :param blocks: Blocks in order
+        :return: List with an entry per block. True if every signature in block is valid,
+        False if a signature is invalid, None if verification stopped before block was checked.
+        """
+        tasks, results = SignatureVerifier.collect(blocks)
+        pending = [0] * len(blocks)
+        for i, _ in tasks:
+            pending[i] += 1
+        if len(tasks) < SignatureVerifier.min_pool_tasks:
+            for i, task in tasks:
+                if not verify_task(task):
+                    results[i] = False
+                    return SignatureVerifier.fail_fast(results, pending)
+                signature_cache.add(task)
+                pending[i] -= 1
+            return results
+
+        with self.lock:
+            if self.pool is None:
+                self.abort_event = multiprocessing.Event()
+                self.pool = multiprocessing.Pool(self.processes, initializer=init_worker,
+                                                 initargs=(self.abort_event,))
+            self.abort_event.clear()
+            failed = False
+            try:
+                for j, result in self.pool.imap_unordered(verify_indexed_task, enumerate(tasks),
+                                                          chunksize=SignatureVerifier.chunk_size):
+                    if failed or result is None:
+                        continue
+                    i, task = tasks[j]
+                    if not result:
+                        results[i] = False
+                        failed = True
+                        # Workers skip what is left. Iteration continues only to drain the pool.
+                        self.abort_event.set()
+                    else:
+                        signature_cache.add(task)
+                        pending[i] -= 1
+            finally:
+                self.abort_event.clear()
+        if failed:
+            return SignatureVerifier.fail_fast(results, pending)
+        return results
+
+    @staticmethod
+    def fail_fast(results, pending):
+        for i in range(len(results)):
+            if results[i] is True and pending[i] > 0:
+                results[i] = None
+        return results
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None